@@ -1,47 +1,106 @@
+import hashlib
+import json
+
 import snowflake.snowpark.functions as F
+from snowflake.snowpark import Window
 from snowflake.snowpark.functions import col
-from snowflake.snowpark.types import FloatType
-
-def generate_demo_data(session, num_customers=1000, ltv_multiplier=1, session_length_multiplier=1, month=5, start_year=2024, end_year=2024):
-    random_id = F.uniform(0,5, F.random()).as_('RAND_ID')
-    email = F.concat(F.call_builtin('RANDSTR', 10, F.random()), F.lit('@'), F.call_builtin('RANDSTR', 5, F.random()), F.lit('.com')).as_('EMAIL')
-    gender = F.when(F.uniform(1,10,F.random())<=7, F.lit('MALE')).otherwise('FEMALE').as_('GENDER')
-    LIFE_TIME_VALUE = (F.round(F.uniform(100,75000,F.random()) / 100, 2) * ltv_multiplier).as_('LIFE_TIME_VALUE')
-    month_col = (F.lit(str(end_year) + str(month))).as_('YEAR_MONTH')
+from snowflake.snowpark.types import FloatType, IntegerType
+
+# The generated tables and their columns
+DEMO_TABLES = {'CUSTOMER_LIFE_TIME_VALUE': ['EMAIL','LIFE_TIME_VALUE','YEAR_MONTH'],
+               'CUSTOMER_GENERAL_DATA': ['EMAIL','GENDER','MEMBERSHIP_STATUS','MEMBER_JOIN_DATE'],
+               'CUSTOMER_BEHAVIOR_DATA': ['EMAIL','AVG_SESSION_LENGTH_MIN','AVG_TIME_ON_APP_MIN','AVG_TIME_ON_WEBSITE_MIN']}
+
+# Table with the hash of the parameters for each seeded generation, used to skip generating the same data again
+GENERATED_TABLE = 'DEMO_DATA_GENERATED'
+
+def random_gen(seed=None, offset=0):
+    # Without a seed RANDOM() is used, with a seed the value is a hash of the seed, an offset unique for each random column
+    # and the customer and month, so the same parameters always gives the same rows
+    if seed is None:
+        return F.random()
+    return F.hash(F.lit(seed), F.lit(offset), col('CUSTOMER_ID'), col('YEAR_MONTH'))
+
+def params_hash(**params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def is_generated(session, data_hash):
+    if not session.sql(f"SHOW TABLES LIKE '{GENERATED_TABLE}'").collect():
+        return False
+    # The data is only there if the tables have not been dropped since
+    return session.table(GENERATED_TABLE).filter(col('PARAMS_HASH') == data_hash).count() > 0 \
+        and all(session.sql(f"SHOW TABLES LIKE '{table_name}'").collect() for table_name in DEMO_TABLES)
+
+def month_range(start_year, start_month, end_year, end_month):
+    # All (year, month) between the start and end month, both included
+    return [(m // 12, m % 12 + 1) for m in range(start_year * 12 + start_month - 1, end_year * 12 + end_month)]
+
+def generate_demo_data(session, num_customers=1000, ltv_multiplier=1, session_length_multiplier=1, month=5, start_year=2024, end_year=2024, seed=None):
+    generate_demo_data_bulk(session, num_customers, [(end_year, month)], ltv_multiplier, session_length_multiplier, start_year, seed)
+
+def generate_demo_data_bulk(session, num_customers=1000, months=None, ltv_multiplier=1, session_length_multiplier=1, start_year=2024, seed=None):
+    if months is None:
+        months = [(2024, 5)]
+    if seed is not None:
+        # Seeded data is the same for the same parameters, so it only needs to be generated once
+        data_params = {'num_customers': num_customers, 'months': [list(m) for m in months], 'ltv_multiplier': ltv_multiplier,
+                       'session_length_multiplier': session_length_multiplier, 'start_year': start_year, 'seed': seed}
+        data_hash = params_hash(**data_params)
+        if is_generated(session, data_hash):
+            print(f'Data for seed {seed} and the same parameters already exists in the tables, hash: {data_hash}')
+            return
+
+    # One row per customer and month, the random values are drawn after the join so each month gets new customers
+    df_months = session.create_dataframe([[year, month, str(year) + str(month)] for year, month in months], schema=['CUR_YEAR', 'CUR_MONTH', 'YEAR_MONTH'])
+    # ROW_NUMBER gives the same ids every time, SEQ8 can have gaps
+    df_customers = session.generator(F.row_number().over(Window.order_by(F.seq8())).as_('CUSTOMER_ID'), rowcount=num_customers)
+
+    random_id = F.uniform(0,5, random_gen(seed, 1)).as_('RAND_ID')
+    email = F.concat(F.call_builtin('RANDSTR', 10, random_gen(seed, 2)), F.lit('@'), F.call_builtin('RANDSTR', 5, random_gen(seed, 3)), F.lit('.com')).as_('EMAIL')
+    gender = F.when(F.uniform(1,10,random_gen(seed, 4))<=7, F.lit('MALE')).otherwise('FEMALE').as_('GENDER')
+    LIFE_TIME_VALUE = (F.round(F.uniform(100,75000,random_gen(seed, 5)) / 100, 2) * ltv_multiplier).as_('LIFE_TIME_VALUE')
     membership_status = F.when(col('LIFE_TIME_VALUE') < 150, F.lit('BASIC'))\
         .when(col('LIFE_TIME_VALUE') < 250, F.lit('BRONZE'))\
             .when(col('LIFE_TIME_VALUE') < 350, F.lit('SILVER'))\
                 .when(col('LIFE_TIME_VALUE') < 550, F.lit('GOLD'))\
                     .when(col('LIFE_TIME_VALUE') < 650, F.lit('PLATIN'))\
                         .when(col('LIFE_TIME_VALUE') >= 650, F.lit('DIAMOND')).as_('MEMBERSHIP_STATUS')
-    membership_year = F.uniform(start_year, end_year,F.random(3)).as_("YEAR")
-    #membership_length = F.date_from_parts(F.uniform(start_year, end_year,F.random(3))
-    #                                      ,F.uniform(start_month,end_month,F.random(2))
-    #                                      ,F.uniform(1,28,F.random(1))).as_('MEMBER_JOIN_DATE')
-    avg_session_length = (col('LIFE_TIME_VALUE') / 100 + F.uniform(0,5, F.random()) * session_length_multiplier).cast(FloatType()).as_('AVG_SESSION_LENGTH_MIN')
-    avg_time_on_app = (col('LIFE_TIME_VALUE') / 100 + F.uniform(1,7, F.random())).cast(FloatType()).as_('AVG_TIME_ON_APP_MIN')
-    avg_time_on_website = (col('LIFE_TIME_VALUE') / 100 + F.uniform(3,7, F.random())).cast(FloatType()).as_('AVG_TIME_ON_WEBSITE_MIN')
-
-    df = session.generator(random_id, email, month_col, LIFE_TIME_VALUE, gender,membership_status, membership_year, avg_session_length, avg_time_on_app, avg_time_on_website, rowcount=num_customers)
-
-    # Add a month column, that is the month when the 
-    df = df.with_column('MEMBER_JOIN_DATE', F.date_from_parts(col('YEAR'), F.iff(col("YEAR") <  end_year
-                                                                                  , F.uniform(1, 12 ,F.random(2))
-                                                                                  , F.uniform(1, month, F.random(2)))
-                                                                        , F.uniform(1,28,F.random(1))))
+    # UNIFORM needs constant bounds, so a year between start_year and the year of the row is start_year + a share of the years
+    membership_year = (F.lit(start_year) + F.floor(F.uniform(0.0, 1.0, random_gen(seed, 6)) * (col('CUR_YEAR') - start_year + 1))).cast(IntegerType()).as_("YEAR")
+    avg_session_length = (col('LIFE_TIME_VALUE') / 100 + F.uniform(0,5, random_gen(seed, 7)) * session_length_multiplier).cast(FloatType()).as_('AVG_SESSION_LENGTH_MIN')
+    avg_time_on_app = (col('LIFE_TIME_VALUE') / 100 + F.uniform(1,7, random_gen(seed, 8))).cast(FloatType()).as_('AVG_TIME_ON_APP_MIN')
+    avg_time_on_website = (col('LIFE_TIME_VALUE') / 100 + F.uniform(3,7, random_gen(seed, 9))).cast(FloatType()).as_('AVG_TIME_ON_WEBSITE_MIN')
+
+    df = df_customers.cross_join(df_months).select('CUSTOMER_ID', 'CUR_YEAR', 'CUR_MONTH', 'YEAR_MONTH', random_id, email, LIFE_TIME_VALUE, gender, membership_year)
+    df = df.select('*', membership_status, avg_session_length, avg_time_on_app, avg_time_on_website)
+
+    # Add a month column, that is the month when the customer joined, not after the month of the row
+    join_month = F.iff(col("YEAR") < col('CUR_YEAR'), F.uniform(1, 12 ,random_gen(seed, 10)), F.lit(1) + F.floor(F.uniform(0.0, 1.0, random_gen(seed, 10)) * col('CUR_MONTH')))
+    df = df.with_column('MEMBER_JOIN_DATE', F.date_from_parts(col('YEAR'), join_month, F.uniform(1,28,random_gen(seed, 11))))
     # Add some missing data
     df = df.with_column('AVG_SESSION_LENGTH_MIN', F.when(col('RAND_ID') == 2, None).otherwise(col('AVG_SESSION_LENGTH_MIN')))
     df = df.with_column('AVG_TIME_ON_APP_MIN', F.when(col('RAND_ID') == 3, None).otherwise(col('AVG_TIME_ON_APP_MIN')))
     df = df.with_column('AVG_TIME_ON_WEBSITE_MIN', F.when(col('RAND_ID') == 4, None).otherwise(col('AVG_TIME_ON_WEBSITE_MIN')))
-    df = df.drop(['RAND_ID', 'YEAR']).cache_result()
-
-    # Save Tables
-    ltv_table_name = f'CUSTOMER_LIFE_TIME_VALUE'
-    generaldata_table_name = f'CUSTOMER_GENERAL_DATA'
-    behaviordata_table_name = f'CUSTOMER_BEHAVIOR_DATA'
-    df[['EMAIL','LIFE_TIME_VALUE','YEAR_MONTH']].write.save_as_table(ltv_table_name, mode='append')
-    print(f'Added {num_customers} customers to table: {ltv_table_name} for YEAR_MONTH: {str(end_year) + str(month)}')
-    df[['EMAIL','GENDER','MEMBERSHIP_STATUS','MEMBER_JOIN_DATE']].write.save_as_table(generaldata_table_name, mode='append')
-    print(f'Added {num_customers} customers to table: {generaldata_table_name}')
-    df[['EMAIL','AVG_SESSION_LENGTH_MIN','AVG_TIME_ON_APP_MIN','AVG_TIME_ON_WEBSITE_MIN']].write.save_as_table(behaviordata_table_name, mode='append')
-    print(f'Added {num_customers} customers to table: {behaviordata_table_name}')
\ No newline at end of file
+    df = df.drop(['CUSTOMER_ID', 'RAND_ID', 'YEAR', 'CUR_YEAR', 'CUR_MONTH'])
+
+    # Create the tables if they do not exist, with the column types of the generated data
+    for table_name, columns in DEMO_TABLES.items():
+        df[columns].limit(0).write.save_as_table(table_name, mode='append')
+
+    # Save Tables, a multi-table insert writes the same generated rows to all tables in one job, without caching them first
+    into = ' '.join(f"INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(columns)})" for table_name, columns in DEMO_TABLES.items())
+    queries = df.queries['queries']
+    try:
+        for query in queries[:-1]:
+            session.sql(query).collect()
+        session.sql(f"INSERT ALL {into} {queries[-1]}").collect()
+    finally:
+        # Drops the temporary objects created by the queries, ie the temporary table create_dataframe uses for many months
+        for query in df.queries['post_actions']:
+            session.sql(query).collect()
+    for table_name in DEMO_TABLES:
+        print(f'Added {num_customers} customers to table: {table_name} for YEAR_MONTH: {", ".join(str(year) + str(month) for year, month in months)}')
+
+    if seed is not None:
+        session.sql(f"CREATE TABLE IF NOT EXISTS {GENERATED_TABLE} (PARAMS_HASH VARCHAR, PARAMS VARIANT, GENERATED_AT TIMESTAMP_LTZ)").collect()
+        session.sql(f"INSERT INTO {GENERATED_TABLE} SELECT '{data_hash}', PARSE_JSON('{json.dumps(data_params)}'), CURRENT_TIMESTAMP()").collect()
@@ -0,0 +1,106 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import joblib
+
+# Max number of models and total size of the model files kept in memory by each Python process
+MAX_MODELS = 8
+MAX_BYTES = 2 * 1024 ** 3
+
+
+class ModelCache:
+    # Least recently used models are evicted when there are more than max_models or the files of the cached models
+    # are bigger than max_bytes. The key includes the version of the file, so a new version put to the stage is
+    # loaded instead of the cached one
+
+    def __init__(self, max_models=MAX_MODELS, max_bytes=MAX_BYTES):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        # (path, version) -> (model, size of the file)
+        self.models = OrderedDict()
+        self.total_bytes = 0
+        self.metrics = {"hits": 0, "misses": 0, "evictions": 0, "load_seconds": 0.0, "last_load_seconds": None}
+        # A vectorized UDF can be called from several threads in the same process
+        self.lock = threading.Lock()
+
+    def get(self, path, version, loader, size=0):
+        key = (path, version)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.metrics["hits"] += 1
+                return self.models[key][0]
+
+        start_time = time.time()
+        model = loader()
+        load_seconds = time.time() - start_time
+
+        with self.lock:
+            self.metrics["misses"] += 1
+            self.metrics["load_seconds"] += load_seconds
+            self.metrics["last_load_seconds"] = load_seconds
+            # Older versions of the same file are not used anymore
+            for old_key in [k for k in self.models if k[0] == path and k != key]:
+                self.remove(old_key)
+            if key not in self.models:
+                self.models[key] = (model, size)
+                self.total_bytes += size
+            self.evict()
+        return model
+
+    def remove(self, key):
+        _, size = self.models.pop(key)
+        self.total_bytes -= size
+
+    def evict(self):
+        # The last loaded model is always kept, even if it is bigger than max_bytes
+        while len(self.models) > 1 and (len(self.models) > self.max_models or self.total_bytes > self.max_bytes):
+            self.remove(next(iter(self.models)))
+            self.metrics["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.total_bytes = 0
+
+    def info(self):
+        with self.lock:
+            return {**self.metrics, "models": [{"path": path, "version": version, "size": size}
+                                               for (path, version), (_, size) in self.models.items()],
+                    "total_bytes": self.total_bytes}
+
+
+# Shared by all the functions in the process that use load_model
+model_cache = ModelCache()
+
+
+def model_path(filename):
+    # Files added with imports are in the import directory of the UDF, outside Snowflake the filename is used as is
+    import_dir = sys._xoptions.get("snowflake_import_directory")
+    return os.path.join(import_dir, filename) if import_dir else filename
+
+
+def load_model(filename, version=None, mmap_mode=None, cache=None):
+    # Loads a joblib file once for each version. Without a version the modification time and size of the file
+    # are used, an ETag or MD5 from the directory table of the stage can be used instead.
+    # With mmap_mode='r' the numpy arrays of a file saved without compression are memory-mapped instead of read
+    cache = cache or model_cache
+    path = model_path(filename)
+    stat = os.stat(path)
+    if version is None:
+        version = (stat.st_mtime_ns, stat.st_size)
+    return cache.get(path, version, lambda: joblib.load(path, mmap_mode=mmap_mode), stat.st_size)
+
+
+def warmup(filenames, mmap_mode=None, cache=None):
+    # Loads the models before the first batch, for example in the __init__ of a UDTF
+    for filename in filenames:
+        load_model(filename, mmap_mode=mmap_mode, cache=cache)
+    return cache_info(cache)
+
+
+def cache_info(cache=None):
+    return (cache or model_cache).info()
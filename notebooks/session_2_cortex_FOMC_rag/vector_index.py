@@ -0,0 +1,214 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import snowflake.snowpark.functions as F
+
+# Same model and size as the embeddings in FED_VECTOR_STORE
+EMBED_MODEL = 'snowflake-arctic-embed-m'
+EMBEDDING_DIM = 768
+# Number of rows scored at a time by a brute force search, bounds the memory used for a large index
+SEARCH_BLOCK_ROWS = 65_536
+# Share of deleted rows in the files above which a refresh compacts the index
+MAX_DELETED_SHARE = 0.25
+
+
+def to_matrix(embeddings):
+    # VECTOR and ARRAY columns can come back from to_pandas as lists or JSON strings. The rows are normalized
+    # so the dot product is the cosine similarity
+    matrix = np.array([json.loads(e) if isinstance(e, str) else e for e in embeddings], dtype=np.float32)
+    matrix = matrix.reshape(-1, EMBEDDING_DIM)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def embed_questions(session, questions):
+    # One query for all the questions, embedded the same way as the chunks
+    df = session.create_dataframe([[i, q] for i, q in enumerate(questions)], schema=["QUERY_ID", "QUESTION"])
+    pd_embeddings = df.select("QUERY_ID",
+                              F.sql_expr(f"snowflake.cortex.embed_text_768('{EMBED_MODEL}', QUESTION)::ARRAY")
+                              .as_("EMBEDDING")) \
+        .sort("QUERY_ID").to_pandas()
+    return to_matrix(pd_embeddings["EMBEDDING"])
+
+
+def top_k(scores, k):
+    # Index of the k highest scores in each row, highest first
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+class LocalVectorIndex:
+    # Local copy of FED_VECTOR_STORE. The normalized embeddings are stored as a float32 matrix in embeddings.f32
+    # and memory-mapped, the press conference, chunk and hash of each row are stored in rows.pkl
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.embeddings_file = os.path.join(path, "embeddings.f32")
+        self.rows_file = os.path.join(path, "rows.pkl")
+        self.ivf_file = os.path.join(path, "ivf.npz")
+
+        if os.path.exists(self.rows_file):
+            self.rows = pd.read_pickle(self.rows_file)
+        else:
+            self.rows = pd.DataFrame({"PRESS_CONF": pd.Series(dtype=str), "CHUNK": pd.Series(dtype=str),
+                                      "CHUNK_HASH": pd.Series(dtype=str), "DELETED": pd.Series(dtype=bool)})
+
+        # Optional IVF clustering, the centroids and the list of each row
+        self.centroids = None
+        self.lists = None
+        if os.path.exists(self.ivf_file):
+            ivf = np.load(self.ivf_file)
+            self.centroids = ivf["centroids"]
+            self.lists = ivf["lists"]
+
+        self.open()
+
+    def __len__(self):
+        return int((~self.rows["DELETED"]).sum())
+
+    def open(self):
+        # Only the pages of the matrix used by a search are read from disk
+        n_rows = len(self.rows)
+        if n_rows == 0:
+            self.embeddings = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        else:
+            self.embeddings = np.memmap(self.embeddings_file, dtype=np.float32, mode="r",
+                                        shape=(n_rows, EMBEDDING_DIM))
+
+    def save(self):
+        self.rows.to_pickle(self.rows_file)
+        if self.centroids is not None:
+            np.savez(self.ivf_file, centroids=self.centroids, lists=self.lists)
+
+    def update(self, pd_new, keys):
+        # Appends the new rows and flags the rows whose (PRESS_CONF, CHUNK_HASH) is no longer in keys
+        live_keys = pd.MultiIndex.from_frame(self.rows[["PRESS_CONF", "CHUNK_HASH"]])
+        self.rows["DELETED"] |= ~live_keys.isin(keys)
+
+        pd_new = pd_new.drop_duplicates(["PRESS_CONF", "CHUNK_HASH"])
+        if len(pd_new) > 0:
+            matrix = to_matrix(pd_new["EMBEDDING"])
+            with open(self.embeddings_file, "ab") as f:
+                matrix.tofile(f)
+            self.rows = pd.concat([self.rows, pd_new[["PRESS_CONF", "CHUNK", "CHUNK_HASH"]].assign(DELETED=False)],
+                                  ignore_index=True)
+            if self.centroids is not None:
+                # New rows go to the nearest existing list, build_ivf trains the lists again
+                self.lists = np.concatenate([self.lists, self.assign(matrix)])
+
+        self.save()
+        self.open()
+        if self.rows["DELETED"].mean() > MAX_DELETED_SHARE:
+            self.compact()
+        return len(pd_new)
+
+    def refresh(self, session, table="FED_VECTOR_STORE"):
+        # Only the keys are read to find the changes, the embeddings are fetched for the new rows only
+        df_store = session.table(table)
+        pd_keys = df_store.select("PRESS_CONF", "CHUNK_HASH").distinct().to_pandas()
+        keys = pd.MultiIndex.from_frame(pd_keys[["PRESS_CONF", "CHUNK_HASH"]])
+
+        live = self.rows[~self.rows["DELETED"]]
+        new_keys = keys[~keys.isin(pd.MultiIndex.from_frame(live[["PRESS_CONF", "CHUNK_HASH"]]))]
+        if len(new_keys) == 0:
+            pd_new = pd.DataFrame(columns=["PRESS_CONF", "CHUNK", "CHUNK_HASH", "EMBEDDING"])
+        else:
+            df_new = df_store
+            if len(live) > 0:
+                df_new = df_store.join(session.create_dataframe(list(new_keys), schema=["PRESS_CONF", "CHUNK_HASH"]),
+                                       on=["PRESS_CONF", "CHUNK_HASH"], how="leftsemi")
+            pd_new = df_new.select("PRESS_CONF", "CHUNK", "CHUNK_HASH",
+                                   F.col("CHUNK_EMBEDDING").cast("ARRAY").as_("EMBEDDING")).to_pandas()
+
+        return self.update(pd_new, keys)
+
+    def compact(self):
+        # Removes the deleted rows from the files
+        keep = ~self.rows["DELETED"].to_numpy()
+        tmp_file = self.embeddings_file + ".tmp"
+        np.asarray(self.embeddings[keep]).tofile(tmp_file)
+        self.embeddings = None
+        os.replace(tmp_file, self.embeddings_file)
+
+        self.rows = self.rows[keep].reset_index(drop=True)
+        if self.centroids is not None:
+            self.lists = self.lists[keep]
+        self.save()
+        self.open()
+
+    def assign(self, matrix):
+        return np.argmax(matrix @ self.centroids.T, axis=1).astype(np.int32)
+
+    def build_ivf(self, n_lists=None, n_iter=10, seed=0):
+        # Spherical k-means on the rows, a search then only scores the rows of the lists nearest to the question
+        live = np.flatnonzero(~self.rows["DELETED"].to_numpy())
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(live)))), len(live))
+        matrix = np.asarray(self.embeddings[live])
+
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(live), n_lists, replace=False)]
+        for _ in range(n_iter):
+            lists = np.argmax(matrix @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, lists, matrix)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # An empty list keeps its centroid
+            centroids = np.where(norms > 0, sums / np.where(norms == 0, 1, norms), centroids)
+
+        self.centroids = centroids.astype(np.float32)
+        self.lists = np.zeros(len(self.rows), dtype=np.int32)
+        self.lists[live] = self.assign(matrix)
+        self.save()
+
+    def search(self, query_vectors, k=5, n_probe=None):
+        # Top k rows by cosine similarity for each query. With n_probe and an IVF, only the rows in the n_probe
+        # nearest lists are scored
+        queries = to_matrix(query_vectors)
+        live = ~self.rows["DELETED"].to_numpy()
+        n_rows = len(self.rows)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+
+        if n_probe and self.centroids is not None:
+            probe = top_k(queries @ self.centroids.T, n_probe)
+            matches = []
+            for q, lists in enumerate(probe):
+                candidates = np.flatnonzero(live & np.isin(self.lists, lists))
+                scores = (self.embeddings[candidates] @ queries[q])[np.newaxis, :]
+                top = top_k(scores, k)[0] if len(candidates) > 0 else np.zeros(0, dtype=np.int64)
+                matches.append((candidates[top], scores[0, top]))
+            width = max(len(rows) for rows, _ in matches)
+            best_rows = np.zeros((len(queries), width), dtype=np.int64)
+            best_scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+            for q, (rows, scores) in enumerate(matches):
+                best_rows[q, :len(rows)] = rows
+                best_scores[q, :len(rows)] = scores
+        else:
+            # Brute force, all the queries are scored together one block of rows at a time
+            for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+                end = min(start + SEARCH_BLOCK_ROWS, n_rows)
+                scores = queries @ np.asarray(self.embeddings[start:end]).T
+                scores[:, ~live[start:end]] = -np.inf
+                block_rows = np.broadcast_to(np.arange(start, end), scores.shape)
+                scores = np.hstack([best_scores, scores])
+                rows = np.hstack([best_rows, block_rows])
+                top = top_k(scores, k)
+                best_rows = np.take_along_axis(rows, top, axis=1)
+                best_scores = np.take_along_axis(scores, top, axis=1)
+
+        query_ids, ranks = np.indices(best_rows.shape)
+        pd_results = pd.DataFrame({"QUERY_ID": query_ids.ravel(), "RANK": ranks.ravel() + 1,
+                                   "SCORE": best_scores.ravel(), "ROW": best_rows.ravel()})
+        pd_results = pd_results[np.isfinite(pd_results["SCORE"])]
+        return pd_results.join(self.rows[["PRESS_CONF", "CHUNK"]], on="ROW").drop(columns="ROW") \
+            .reset_index(drop=True)
+
+    def search_questions(self, session, questions, k=5, n_probe=None):
+        # Only the questions are embedded in Snowflake, the search runs locally
+        pd_results = self.search(embed_questions(session, questions), k, n_probe)
+        return pd_results.assign(QUESTION=pd_results["QUERY_ID"].map(dict(enumerate(questions))))
@@ -0,0 +1,73 @@
+###################################################################################
+# Micro-benchmark of the ways the Monte Carlo simulations can draw standard normal values.
+#
+# For each sampler it measures the cold start, the first call after the UDF has been
+# registered again, and the rows/sec when drawing n_rows values.
+#
+# python benchmark_normal_samplers.py 'my_path/creds.json' 'database' 'schema' 'stage' [n_rows]
+##################################################################################
+
+import json
+import sys
+import time
+
+from snowflake.snowpark.session import Session
+from snowflake.snowpark import functions as F
+
+from lib.snf_functions import MCS_FUNCTIONS, NORMAL_SAMPLERS, normal_draw, register_function
+
+# Number of rows used when measuring the cold start
+COLD_START_ROWS = 1000
+
+
+def time_query(df):
+    start_time = time.time()
+    row = df.collect()[0]
+    return time.time() - start_time, row
+
+
+def run_benchmark(session, data_db, data_schema, stage_loc, n_rows):
+    # Make sure every query is executed
+    session.sql("ALTER SESSION SET USE_CACHED_RESULT = FALSE").collect()
+
+    results = []
+    for label, sampler in NORMAL_SAMPLERS.items():
+        if sampler.upper() in MCS_FUNCTIONS:
+            # Register the UDF again so the first call needs a new sandbox
+            register_function(session, sampler.upper(), data_db, data_schema, stage_loc)
+
+        def draw(rowcount):
+            return session.generator(normal_draw(sampler, data_db, data_schema).as_("Z"), rowcount=rowcount) \
+                .select(F.avg("Z").as_("MEAN"), F.stddev("Z").as_("STD_DEV"))
+
+        cold_start, _ = time_query(draw(COLD_START_ROWS))
+        elapsed, row = time_query(draw(n_rows))
+        results.append((label, cold_start, n_rows / elapsed, row["MEAN"], row["STD_DEV"]))
+
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print('Too few arguments')
+        sys.exit(1)
+
+    creds_file = sys.argv[1]
+    data_db = sys.argv[2]
+    data_schema = sys.argv[3]
+    stage_name = sys.argv[4]
+    n_rows = int(sys.argv[5]) if len(sys.argv) > 5 else 10_000_000
+
+    with open(creds_file) as f:
+        connection_parameters = json.load(f)
+
+    session = Session.builder.configs(connection_parameters).create()
+    session.use_schema(f"{data_db}.{data_schema}")
+
+    print(f"{'Sampler':40} {'Cold start (s)':>15} {'Rows/sec':>15} {'Mean':>10} {'Std dev':>10}")
+    for label, cold_start, rows_sec, mean, std_dev in run_benchmark(session, data_db, data_schema,
+                                                                    f"{data_db}.{data_schema}.{stage_name}",
+                                                                    n_rows):
+        print(f"{label:40} {cold_start:15.2f} {rows_sec:15,.0f} {mean:10.4f} {std_dev:10.4f}")
+
+    session.close()
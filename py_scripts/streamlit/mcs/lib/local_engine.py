@@ -0,0 +1,301 @@
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, qmc
+
+# Max number of simulated values (days * runs) returned as one DataFrame, above that use summarize_simulations
+MAX_CELLS = 50_000_000
+# Number of simulated values generated by each chunk
+CHUNK_CELLS = 1_000_000
+# Number of bins of the histogram of each day in a SimulationSummary, over +/- QUANTILE_RANGE standard deviations
+QUANTILE_BINS = 2000
+QUANTILE_RANGE = 8.0
+
+# The ways the standard normal values for a path can be drawn, label shown in the sidebar -> sampling name
+SAMPLING_METHODS = {"Pseudo-random": "random", "Antithetic variates": "antithetic", "Sobol (quasi-random)": "sobol"}
+# Number of simulation runs sharing one scrambled Sobol sequence, a power of 2 keeps each block balanced
+SOBOL_BLOCK_RUNS = 32
+
+
+def get_gbm_params(pd_closing: pd.DataFrame) -> dict:
+    # Same calculations as the Snowflake backend, VARIANCE and STDDEV in Snowflake are the sample versions
+    close = pd_closing.sort_values("DATE")["CLOSE"].astype(float)
+    log_returns = np.log1p(close.pct_change()).dropna()
+
+    u = log_returns.mean()
+    var = log_returns.var(ddof=1)
+    return {"DRIFT": u - 0.5 * var, "STD_DEV": log_returns.std(ddof=1), "LAST_CLOSE": float(close.iloc[-1])}
+
+
+def resolve_seed(seed=None, sampling="random"):
+    # Antithetic pairs and Sobol blocks can be split over chunks and partitions, they need a seed to draw the
+    # same values everywhere
+    if seed is None and sampling != "random":
+        return int(np.random.SeedSequence().entropy % 2 ** 31)
+    return seed
+
+
+def sampling_units(sim_runs, sampling="random"):
+    # The independent units of a sampling method, the standard error is calculated from the mean of each unit
+    sim_runs = np.asarray(sim_runs, dtype=np.int64)
+    if sampling == "antithetic":
+        return (sim_runs + 1) // 2
+    if sampling == "sobol":
+        return (sim_runs - 1) // SOBOL_BLOCK_RUNS
+    return sim_runs
+
+
+def standard_normals(sim_runs, n_days: int, seed=None, sampling="random", dtype=np.float64) -> np.ndarray:
+    # Used by both the local engine and the GBM_PATHS UDTF, a path only depends on the seed, sampling and
+    # SIM_RUN and not on how the runs are chunked or partitioned
+    sim_runs = np.asarray(sim_runs, dtype=np.int64)
+    z = np.empty((len(sim_runs), n_days), dtype=dtype)
+
+    if sampling == "sobol":
+        # Each block of runs uses its own scrambled sequence, with one dimension per day, and the run is the
+        # point in the sequence
+        blocks = (sim_runs - 1) // SOBOL_BLOCK_RUNS
+        points = (sim_runs - 1) % SOBOL_BLOCK_RUNS
+        for block in np.unique(blocks):
+            in_block = blocks == block
+            rng = np.random.default_rng(None if seed is None else [int(seed), int(block)])
+            sobol = qmc.Sobol(d=n_days, scramble=True, seed=rng)
+            first_point = int(points[in_block].min())
+            if first_point > 0:
+                sobol.fast_forward(first_point)
+            with warnings.catch_warnings():
+                # Sobol warns when the number of points is not a power of 2
+                warnings.simplefilter("ignore")
+                u = sobol.random(int(points[in_block].max()) - first_point + 1)
+            # Keep away from 0 and 1 where the inverse CDF is infinite
+            z[in_block] = norm.ppf(np.clip(u[points[in_block] - first_point], 1e-12, 1 - 1e-12))
+        return z
+
+    if sampling == "antithetic":
+        # Run 2k-1 uses Z and run 2k uses -Z, the errors of a pair cancels out
+        draw_ids = (sim_runs + 1) // 2
+        signs = np.where(sim_runs % 2 == 1, 1.0, -1.0)
+    else:
+        draw_ids = sim_runs
+        signs = np.ones(len(sim_runs))
+
+    # One generator per draw
+    for i, draw_id in enumerate(draw_ids):
+        rng = np.random.default_rng(None if seed is None else [int(seed), int(draw_id)])
+        z[i] = signs[i] * rng.standard_normal(n_days, dtype=dtype)
+    return z
+
+
+def expected_price_estimate(sim_runs, final_close, sampling="random"):
+    # Returns the number of paths, the expected price and its standard error. The units are independent so the
+    # standard error is the standard deviation of the unit means / sqrt(number of units)
+    pd_units = pd.DataFrame({"UNIT": sampling_units(sim_runs, sampling), "SIM_CLOSE": final_close}) \
+        .groupby("UNIT")["SIM_CLOSE"].agg(["mean", "size"])
+    std_error = pd_units["mean"].std(ddof=1) / np.sqrt(len(pd_units)) if len(pd_units) >= 2 else np.nan
+    return int(pd_units["size"].sum()), np.average(pd_units["mean"], weights=pd_units["size"]), std_error
+
+
+class ExpectedPrice:
+    # Running estimate of the expected price, the count, mean and sum of squared deviations of the unit means of each
+    # batch are merged with the previous batches. A unit must not be split between batches
+
+    def __init__(self, sampling="random"):
+        self.sampling = sampling
+        self.n_paths = 0
+        self.sum_close = 0.0
+        self.n_units = 0
+        self.unit_mean = 0.0
+        self.unit_m2 = 0.0
+
+    def add(self, sim_runs, final_close):
+        unit_means = pd.DataFrame({"UNIT": sampling_units(sim_runs, self.sampling), "SIM_CLOSE": final_close}) \
+            .groupby("UNIT")["SIM_CLOSE"].mean().to_numpy(dtype=np.float64)
+        if len(unit_means) == 0:
+            return
+        self.n_paths += len(final_close)
+        self.sum_close += float(np.sum(final_close))
+
+        n_units = self.n_units + len(unit_means)
+        delta = unit_means.mean() - self.unit_mean
+        self.unit_m2 += ((unit_means - unit_means.mean()) ** 2).sum() \
+            + delta ** 2 * self.n_units * len(unit_means) / n_units
+        self.unit_mean += delta * len(unit_means) / n_units
+        self.n_units = n_units
+
+    def estimate(self):
+        # Same as expected_price_estimate on all the batches
+        std_error = np.sqrt(self.unit_m2 / (self.n_units - 1) / self.n_units) if self.n_units >= 2 else np.nan
+        return self.n_paths, self.sum_close / self.n_paths, std_error
+
+
+def convergence_report(sim_runs, final_close, sampling="random", n_steps=10) -> pd.DataFrame:
+    # Expected price and its standard error as more simulation runs are used
+    pd_final = pd.DataFrame({"SIM_RUN": np.asarray(sim_runs), "SIM_CLOSE": np.asarray(final_close)}) \
+        .sort_values("SIM_RUN")
+    units = sampling_units(pd_final["SIM_RUN"], sampling)
+    unit_ids = np.unique(units)
+
+    rows = []
+    for n in np.unique(np.linspace(2, len(unit_ids), n_steps).astype(int)) if len(unit_ids) >= 2 else []:
+        pd_used = pd_final[units <= unit_ids[n - 1]]
+        n_paths, expected_price, std_error = expected_price_estimate(pd_used["SIM_RUN"], pd_used["SIM_CLOSE"],
+                                                                     sampling)
+        rows.append({"N_PATHS": n_paths, "EXPECTED_PRICE": expected_price, "STD_ERROR": std_error,
+                     "CI_95": 1.96 * std_error})
+    return pd.DataFrame(rows, columns=["N_PATHS", "EXPECTED_PRICE", "STD_ERROR", "CI_95"])
+
+
+def simulate_chunk(params: dict, n_days: int, first_run: int, n_runs: int, seed=None,
+                   dtype=np.float64, sampling="random") -> pd.DataFrame:
+    sim_runs = np.arange(first_run, first_run + n_runs, dtype=np.int64)
+
+    # Drawn the same way as the GBM_PATHS UDTF
+    z = standard_normals(sim_runs, n_days, seed, sampling, dtype)
+    log_returns = params["DRIFT"] + params["STD_DEV"] * z
+
+    # Day 0 is the last close, the following days the last close * cumulative product of the daily returns
+    cum_log_returns = np.zeros((n_runs, n_days + 1), dtype=dtype)
+    np.cumsum(log_returns, axis=1, out=cum_log_returns[:, 1:])
+    sim_close = params["LAST_CLOSE"] * np.exp(cum_log_returns)
+
+    return pd.DataFrame({"DAY_ID": np.tile(np.arange(n_days + 1), n_runs),
+                         "SIM_RUN": np.repeat(sim_runs, n_days + 1),
+                         "SIM_CLOSE": sim_close.ravel()})
+
+
+def iter_simulations(params: dict, n_days: int, n_sim_runs: int, seed=None, dtype=np.float64,
+                     max_workers=None, chunk_cells=CHUNK_CELLS, sampling="random"):
+    chunk_runs = max(1, chunk_cells // (n_days + 1))
+    if n_sim_runs <= chunk_runs:
+        # Not worth starting a process pool for one chunk
+        yield simulate_chunk(params, n_days, 1, n_sim_runs, seed, dtype, sampling)
+        return
+
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for first_run in range(1, n_sim_runs + 1, chunk_runs):
+            n_runs = min(chunk_runs, n_sim_runs - first_run + 1)
+            pending.append(pool.submit(simulate_chunk, params, n_days, first_run, n_runs, seed, dtype,
+                                       sampling))
+            # Only keep a couple of chunks per worker in flight so the memory used stays bounded
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class SimulationSummary:
+    # Summary of simulated paths that the chunks are added to one at a time, only the count and sum of the prices
+    # and a histogram for each day, the prices on the last day and the sample paths are kept. The histograms are of
+    # the log return since the last close, standardized with the GBM parameters, so the same bins fit all days.
+    # The quantiles are approximated within a bin, like APPROX_PERCENTILE in Snowflake
+
+    def __init__(self, params: dict, n_days: int, n_sample_paths=0):
+        self.params = params
+        self.n_days = n_days
+        self.n_sample_paths = n_sample_paths
+        days = np.arange(n_days + 1)
+        self.log_mean = params["DRIFT"] * days
+        # Day 0 is always the last close
+        self.log_std = np.maximum(params["STD_DEV"] * np.sqrt(days), 1e-12)
+        self.bin_width = 2 * QUANTILE_RANGE / QUANTILE_BINS
+
+        self.counts = np.zeros(n_days + 1, dtype=np.int64)
+        self.sums = np.zeros(n_days + 1)
+        self.hist = np.zeros((n_days + 1, QUANTILE_BINS), dtype=np.int64)
+        self.finals = []
+        self.paths = []
+
+    def add(self, pd_chunk: pd.DataFrame):
+        day = pd_chunk["DAY_ID"].to_numpy(dtype=np.int64)
+        close = pd_chunk["SIM_CLOSE"].to_numpy(dtype=np.float64)
+        self.counts += np.bincount(day, minlength=self.n_days + 1)
+        self.sums += np.bincount(day, weights=close, minlength=self.n_days + 1)
+
+        z = (np.log(close / self.params["LAST_CLOSE"]) - self.log_mean[day]) / self.log_std[day]
+        bins = ((np.clip(z, -QUANTILE_RANGE, QUANTILE_RANGE) + QUANTILE_RANGE) / self.bin_width).astype(np.int64)
+        bins = np.minimum(bins, QUANTILE_BINS - 1)
+        self.hist += np.bincount(day * QUANTILE_BINS + bins, minlength=self.hist.size).reshape(self.hist.shape)
+
+        self.finals.append(pd_chunk.loc[day == self.n_days, ["SIM_RUN", "SIM_CLOSE"]])
+        if self.n_sample_paths > 0:
+            self.paths.append(pd_chunk[pd_chunk["SIM_RUN"] <= self.n_sample_paths])
+
+    def prices(self, z):
+        # Price of a standardized log return on each day, z has one row for each day
+        return self.params["LAST_CLOSE"] * np.exp(self.log_mean[:, np.newaxis] + z * self.log_std[:, np.newaxis])
+
+    def day_quantiles(self, q):
+        # Quantile q of each day, linear within the bin
+        days = np.arange(self.n_days + 1)
+        cum_counts = np.cumsum(self.hist, axis=1)
+        target = q * self.counts
+        bins = np.minimum((cum_counts < target[:, np.newaxis]).sum(axis=1), QUANTILE_BINS - 1)
+        below = np.where(bins > 0, cum_counts[days, np.maximum(bins - 1, 0)], 0)
+        in_bin = self.hist[days, bins]
+        share = np.where(in_bin > 0, (target - below) / np.maximum(in_bin, 1), 0.5)
+        z = -QUANTILE_RANGE + (bins + share) * self.bin_width
+        return self.prices(z[:, np.newaxis])[:, 0]
+
+    def quantiles(self, q):
+        # Quantiles over the prices of all days, each bin counted at the price of its center
+        centers = -QUANTILE_RANGE + (np.arange(QUANTILE_BINS) + 0.5) * self.bin_width
+        prices = self.prices(np.broadcast_to(centers, self.hist.shape)).ravel()
+        order = np.argsort(prices)
+        cum_counts = np.cumsum(self.hist.ravel()[order])
+        return prices[order][np.minimum(np.searchsorted(cum_counts, np.asarray(q) * cum_counts[-1]), len(order) - 1)]
+
+    def bands(self) -> pd.DataFrame:
+        return pd.DataFrame({"DAY_ID": np.arange(self.n_days + 1), "MEAN": self.sums / np.maximum(self.counts, 1),
+                             "P5": self.day_quantiles(0.05), "P50": self.day_quantiles(0.5),
+                             "P95": self.day_quantiles(0.95)})
+
+    def final_close(self) -> pd.DataFrame:
+        return pd.concat(self.finals, ignore_index=True) if self.finals else \
+            pd.DataFrame({"SIM_RUN": pd.Series(dtype=np.int64), "SIM_CLOSE": pd.Series(dtype=np.float64)})
+
+    def summary(self) -> pd.DataFrame:
+        # Same rows as get_sim_summary on the page, BAND, METRIC and PATH
+        p5, p50, p95 = self.quantiles([0.05, 0.5, 0.95])
+        pd_metrics = pd.DataFrame([{"MEAN": self.sums.sum() / max(self.counts.sum(), 1), "P5": p5, "P50": p50,
+                                    "P95": p95}]).round(2)
+        pd_paths = pd.concat(self.paths, ignore_index=True) if self.paths else \
+            pd.DataFrame(columns=["DAY_ID", "SIM_RUN", "SIM_CLOSE"])
+        return pd.concat([self.bands().assign(ROW_TYPE="BAND"), pd_metrics.assign(ROW_TYPE="METRIC"),
+                          pd_paths.assign(ROW_TYPE="PATH")], ignore_index=True)
+
+
+def resolve_params(df, params=None) -> dict:
+    if params is None:
+        # Accepts both a pandas and a Snowpark DataFrame with DATE and CLOSE columns
+        pd_closing = df.to_pandas() if hasattr(df, "to_pandas") else df
+        params = get_gbm_params(pd_closing)
+    return params
+
+
+def run_simulations(df, n_days, n_sim_runs, seed=None, dtype=np.float64, max_workers=None, max_cells=MAX_CELLS,
+                    params=None, sampling="random"):
+    if (n_days + 1) * n_sim_runs > max_cells:
+        raise ValueError(f"{n_sim_runs} simulations of {n_days} days are too many to keep in memory, "
+                         f"use summarize_simulations instead")
+
+    params = resolve_params(df, params)
+    seed = resolve_seed(seed, sampling)
+    return pd.concat(list(iter_simulations(params, n_days, n_sim_runs, seed, dtype, max_workers, sampling=sampling)),
+                     ignore_index=True)
+
+
+def summarize_simulations(df, n_days, n_sim_runs, seed=None, dtype=np.float64, max_workers=None, params=None,
+                          sampling="random", n_sample_paths=10) -> SimulationSummary:
+    # For any number of simulations, the chunks are added to the summary one at a time and are not kept
+    params = resolve_params(df, params)
+    seed = resolve_seed(seed, sampling)
+    summary = SimulationSummary(params, n_days, n_sample_paths)
+    for pd_chunk in iter_simulations(params, n_days, n_sim_runs, seed, dtype, max_workers, sampling=sampling):
+        summary.add(pd_chunk)
+    return summary
@@ -1,13 +1,180 @@
 import streamlit as st
 
+import time
+import hashlib
+import json
+import threading
+import inspect
+import sys
+import cloudpickle
+from concurrent.futures import ThreadPoolExecutor
 from scipy.stats import norm
 import numpy as np
+import pandas as pd
 from typing import Tuple, Iterable
 
-from snowflake.snowpark import Session
+from snowflake.snowpark import Session, Column, Window
 import snowflake.snowpark.functions as F
 import snowflake.snowpark.types as T
 
+from lib import local_engine
+
+# Max number of points shown in the closing price chart
+MAX_CHART_POINTS = 1000
+
+# Seconds the database metadata is kept before it is loaded again
+METADATA_TTL = 600
+
+# Max number of sessions, in use and idle, for each set of credentials in the session pool
+MAX_POOL_SIZE = 10
+# Seconds a session can be idle in the pool before it is closed
+POOL_IDLE_TIMEOUT = 900
+# Seconds a browser session can hold a session without using it before the pool reclaims it, covers browser tabs
+# that are closed and Streamlit sessions that expire without disconnecting
+POOL_LEASE_TIMEOUT = 3600
+
+
+class SessionPool:
+    # Process wide pool of Snowpark sessions keyed by a hash of the credentials, so browser sessions using the same
+    # credentials reuse already logged in sessions instead of creating a new one each time
+
+    def __init__(self, max_size: int = MAX_POOL_SIZE, idle_timeout: int = POOL_IDLE_TIMEOUT,
+                 lease_timeout: int = POOL_LEASE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lease_timeout = lease_timeout
+        self._lock = threading.Lock()
+        # key -> [(time released, session)]
+        self._idle = {}
+        # id(session) -> (key, session, time last used)
+        self._in_use = {}
+        # key -> number of sessions being created
+        self._creating = {}
+        # id(session) -> database, schema and warehouse the session was created with
+        self._defaults = {}
+
+    @staticmethod
+    def creds_key(creds: dict) -> str:
+        return hashlib.sha256(json.dumps(creds, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _is_healthy(session: Session) -> bool:
+        try:
+            session.sql("SELECT 1").collect()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _context(session: Session) -> dict:
+        row = session.sql("SELECT CURRENT_DATABASE(), CURRENT_SCHEMA(), CURRENT_WAREHOUSE()").collect()[0]
+        return {"database": row[0], "schema": row[1], "warehouse": row[2]}
+
+    def _reset_context(self, session: Session) -> bool:
+        # Sets the database, schema and warehouse back to the ones the session was created with, so the next browser
+        # session does not inherit the context of the previous one. False if that is not possible.
+        # A database or schema can not be unset, if the session was created without one the pages set it after
+        # acquire, so only the parts of the context that were set at creation are reset
+        defaults = self._defaults.get(id(session))
+        if defaults is None:
+            return False
+        defaults = {name: value for name, value in defaults.items() if value is not None}
+        try:
+            if "warehouse" in defaults:
+                session.use_warehouse(defaults["warehouse"])
+            if "database" in defaults:
+                session.use_database(defaults["database"])
+            if "schema" in defaults:
+                session.use_schema(defaults["schema"])
+            context = self._context(session)
+            return all(context[name] == value for name, value in defaults.items())
+        except Exception:
+            return False
+
+    def _close(self, session: Session):
+        self._defaults.pop(id(session), None)
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    def _n_sessions(self, key: str) -> int:
+        return len(self._idle.get(key, [])) + [k for k, _, _ in self._in_use.values()].count(key) \
+            + self._creating.get(key, 0)
+
+    def evict_idle(self):
+        now = time.time()
+        with self._lock:
+            expired = [session for idle in self._idle.values() for released, session in idle
+                       if now - released > self.idle_timeout]
+            self._idle = {key: [(released, session) for released, session in idle
+                                if now - released <= self.idle_timeout] for key, idle in self._idle.items()}
+            # Leases not used for lease_timeout are reclaimed. The session is closed instead of reused, since the
+            # abandoned browser session could still have a reference to it
+            abandoned = [session_id for session_id, (_, _, last_used) in self._in_use.items()
+                         if now - last_used > self.lease_timeout]
+            expired += [self._in_use.pop(session_id)[1] for session_id in abandoned]
+        for session in expired:
+            self._close(session)
+
+    def acquire(self, creds: dict) -> Session:
+        key = self.creds_key(creds)
+        self.evict_idle()
+
+        while True:
+            with self._lock:
+                idle = self._idle.get(key, [])
+                session = idle.pop()[1] if idle else None
+                if session is None:
+                    if self._n_sessions(key) >= self.max_size:
+                        raise RuntimeError(f"All {self.max_size} sessions for this user are in use, try again later")
+                    # Reserve the slot while the session is created
+                    self._creating[key] = self._creating.get(key, 0) + 1
+                    break
+                self._in_use[id(session)] = (key, session, time.time())
+            if self._is_healthy(session):
+                return session
+            with self._lock:
+                del self._in_use[id(session)]
+            self._close(session)
+
+        try:
+            session = Session.builder.configs({**creds, 'client_session_keep_alive': True}).create()
+            self._defaults[id(session)] = self._context(session)
+            with self._lock:
+                self._in_use[id(session)] = (key, session, time.time())
+            return session
+        finally:
+            with self._lock:
+                self._creating[key] -= 1
+
+    def touch(self, session: Session) -> bool:
+        # Renews the lease, False if the session has been reclaimed by the pool
+        self.evict_idle()
+        with self._lock:
+            lease = self._in_use.get(id(session))
+            if lease is None or lease[1] is not session:
+                return False
+            self._in_use[id(session)] = (lease[0], session, time.time())
+            return True
+
+    def release(self, session: Session):
+        with self._lock:
+            lease = self._in_use.pop(id(session), None)
+        # Only pooled if the context could be reset
+        if lease is not None and self._reset_context(session):
+            with self._lock:
+                self._idle.setdefault(lease[0], []).append((time.time(), session))
+        else:
+            # Not created by the pool, reclaimed or the context could not be reset
+            self._close(session)
+        self.evict_idle()
+
+
+@st.cache_resource
+def get_session_pool() -> SessionPool:
+    return SessionPool()
+
 
 def connect_to_snf():
     if 'snowsession' in st.session_state:
@@ -19,35 +186,239 @@ def connect_to_snf():
         'password': st.session_state['snow_password'],
         'warehouse': st.session_state['snow_wh']
     }
-    session = Session.builder.configs(creds).create()
+    try:
+        session = get_session_pool().acquire(creds)
+    except RuntimeError as e:
+        # The pool is full, shown instead of a traceback since this runs as a on_click callback
+        st.error(str(e))
+        return None
     st.session_state['snowsession'] = session
 
     return session
 
 
+def clear_snf_state():
+    del st.session_state['snowsession']
+    st.session_state.pop('install_db', None)
+    st.session_state.pop('install_schema', None)
+    st.session_state.pop('install_stage', None)
+    st.session_state.pop('metadata_catalog', None)
+    st.session_state.pop('snow_identity', None)
+
+
 def disconnect_snf():
     if 'snowsession' in st.session_state:
         session = st.session_state['snowsession']
-        session.close()
-        del st.session_state['snowsession']
-        del st.session_state['install_db']
-        del st.session_state['install_schema']
-        del st.session_state['install_stage']
+        # Return the session to the pool so it can be reused by the next login with the same credentials
+        get_session_pool().release(session)
+        clear_snf_state()
+
+
+def renew_snf_session():
+    # Called on each run of a page, keeps the lease of the session. If the pool has reclaimed the session the user
+    # has to connect again
+    if 'snowsession' in st.session_state and not get_session_pool().touch(st.session_state['snowsession']):
+        clear_snf_state()
+
+
+def norm_ppf(pd_series: T.PandasSeries[float]) -> T.PandasSeries[float]:
+    return norm.ppf(pd_series)
+
+
+# Coefficients, highest order first, for Acklam's rational approximation of the inverse normal CDF.
+# Relative error is below 1.15e-9 so there is no need for scipy
+ACKLAM_A = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02, 1.383577518672690e+02,
+            -3.066479806614716e+01, 2.506628277459239e+00]
+ACKLAM_B = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02, 6.680131188771972e+01,
+            -1.328068155288572e+01, 1.0]
+ACKLAM_C = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549732539343734e+00,
+            4.374664141464968e+00, 2.938163982698783e+00]
+ACKLAM_D = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00, 1.0]
+ACKLAM_P_LOW = 0.02425
+
+# Max number of rows NORM_PPF_FAST gets in each call
+NORM_PPF_BATCH_SIZE = 10000
+
+
+def norm_ppf_fast(pd_series: T.PandasSeries[float]) -> T.PandasSeries[float]:
+    p = pd_series.to_numpy(dtype=np.float64)
+    z = np.full_like(p, np.nan)
+
+    # The tails uses one approximation and the central region another
+    low = (p > 0) & (p < ACKLAM_P_LOW)
+    high = (p > 1 - ACKLAM_P_LOW) & (p < 1)
+    central = (p >= ACKLAM_P_LOW) & (p <= 1 - ACKLAM_P_LOW)
+
+    q = np.sqrt(-2 * np.log(p[low]))
+    z[low] = np.polyval(ACKLAM_C, q) / np.polyval(ACKLAM_D, q)
+    q = np.sqrt(-2 * np.log(1 - p[high]))
+    z[high] = -np.polyval(ACKLAM_C, q) / np.polyval(ACKLAM_D, q)
+    q = p[central] - 0.5
+    r = q * q
+    z[central] = np.polyval(ACKLAM_A, r) * q / np.polyval(ACKLAM_B, r)
+
+    z[p == 0] = -np.inf
+    z[p == 1] = np.inf
+    return pd.Series(z, index=pd_series.index)
+
+
+class CollectListHandler:
+    def __init__(self) -> None:
+        self.list = []
+
+    def process(self, element: float) -> Iterable[Tuple[list]]:
+        self.list.append(element)
+        yield (self.list,)
+
+
+def calc_close(last_close: float, daily_return: list) -> float:
+    pred_close = last_close * np.prod(daily_return)
+    return float(pred_close)
+
+
+# Vectorized UDTF that gets all simulation runs in a partition as one pandas DataFrame and returns the full paths
+class GBMPathsHandler:
+    def end_partition(self, df: T.PandasDataFrame[int, float, float, float, int, int, str]
+                      ) -> T.PandasDataFrame[int, int, float]:
+        sim_runs = df["SIM_RUN"].to_numpy(dtype=np.int64)
+        n_days = int(df["N_DAYS"].iloc[0])
+        seed = df["SEED"].iloc[0]
+        sampling = df["SAMPLING"].iloc[0]
+
+        # Drawn per simulation run so a path is the same regardless of the partition it is in
+        z = local_engine.standard_normals(sim_runs, n_days, None if pd.isna(seed) else int(seed), sampling)
+        log_returns = df["DRIFT"].to_numpy()[:, None] + df["STD_DEV"].to_numpy()[:, None] * z
+
+        # Day 0 is the last close, the following days the last close * cumulative product of the daily returns
+        cum_log_returns = np.concatenate([np.zeros((len(sim_runs), 1)), np.cumsum(log_returns, axis=1)], axis=1)
+        sim_close = df["LAST_CLOSE"].to_numpy()[:, None] * np.exp(cum_log_returns)
+
+        return pd.DataFrame({"DAY_ID": np.tile(np.arange(n_days + 1), len(sim_runs)),
+                             "SIM_RUN": np.repeat(sim_runs, n_days + 1),
+                             "SIM_CLOSE": sim_close.ravel()})
+
+
+# The functions needed for the simulations, name -> handler and the options used when registering it.
+# Functions with a output_schema are registered as UDTFs, helpers are functions from other modules that the
+# handler calls and are only used for the hash
+MCS_FUNCTIONS = {
+    "NORM_PPF": {"handler": norm_ppf, "packages": ["scipy"]},
+    "NORM_PPF_FAST": {"handler": norm_ppf_fast, "packages": ["numpy", "pandas"],
+                      "max_batch_size": NORM_PPF_BATCH_SIZE},
+    "COLLECT_LIST": {"handler": CollectListHandler, "packages": ["typing"]
+        , "output_schema": T.StructType([T.StructField("list", T.ArrayType())])},
+    "CALC_CLOSE": {"handler": calc_close, "packages": ["numpy"]},
+    "GBM_PATHS": {"handler": GBMPathsHandler, "helpers": [local_engine.standard_normals]
+        , "packages": ["numpy", "pandas", "scipy"]
+        , "output_schema": T.StructType([T.StructField("DAY_ID", T.LongType()), T.StructField("SIM_RUN", T.LongType())
+                                           , T.StructField("SIM_CLOSE", T.FloatType())])
+        , "input_types": [T.LongType(), T.FloatType(), T.FloatType(), T.FloatType(), T.LongType(), T.LongType()
+                          , T.StringType()]
+        , "input_names": ["SIM_RUN", "DRIFT", "STD_DEV", "LAST_CLOSE", "N_DAYS", "SEED", "SAMPLING"]},
+}
+
+# The ways the standard normal values for the daily returns can be drawn, label -> sampler name
+NORMAL_SAMPLERS = {"NumPy inverse normal UDF (Acklam)": "norm_ppf_fast", "scipy norm.ppf UDF": "norm_ppf",
+                   "Snowflake NORMAL()": "normal", "Box-Muller (SQL)": "box_muller"}
+
+
+def random_gen(seed=None, offset=0):
+    # Seeding RANDOM makes the generated numbers the same between runs, offset gives another sequence for the seed
+    return F.random(seed + offset) if seed is not None else F.random()
+
+
+def normal_draw(sampler: str, data_db: str, data_schema: str, seed=None) -> Column:
+    if sampler == "normal":
+        # Built in, no UDF and no inverse CDF needed
+        return F.call_builtin("NORMAL", F.lit(0.0), F.lit(1.0), random_gen(seed))
+    if sampler == "box_muller":
+        # sqrt(-2 ln(U1)) * cos(2 pi U2), the open interval avoids LN(0)
+        u1 = F.uniform(F.lit(1e-12), F.lit(1.0), random_gen(seed))
+        u2 = F.uniform(F.lit(0.0), F.lit(1.0), random_gen(seed, 1))
+        return F.sqrt(F.lit(-2.0) * F.call_function("LN", u1)) * F.cos(F.lit(2 * np.pi) * u2)
+    # The inverse CDF UDFs
+    return F.call_function(f"{data_db}.{data_schema}.{sampler}", F.uniform(0.0, 1.0, random_gen(seed)))
+
+
+# The hash of a deployed function is stored in its COMMENT as <prefix><hash>
+HASH_COMMENT_PREFIX = "MCS_HASH:"
+
+
+def referenced_constants(code) -> dict:
+    # Module level constants, numbers, strings and lists of them, read by a function or the methods of a class,
+    # ie ACKLAM_A or SOBOL_BLOCK_RUNS. They are not part of the source of the function
+    functions = [f for f in vars(code).values() if inspect.isfunction(f)] if inspect.isclass(code) else [code]
+    constants = {}
+    for function in functions:
+        code_objects = [function.__code__]
+        while code_objects:
+            code_object = code_objects.pop()
+            # Nested functions, comprehensions and lambdas
+            code_objects += [c for c in code_object.co_consts if inspect.iscode(c)]
+            for const_name in code_object.co_names:
+                value = function.__globals__.get(const_name)
+                if isinstance(value, (int, float, str, list, tuple, dict)):
+                    constants[f"{function.__module__}.{const_name}"] = value
+    return constants
+
+
+def function_hash(name: str) -> str:
+    # Changes when the handler code, the helpers code, the module level constants they use or any of the
+    # registration options, ie packages, types etc, are changed
+    spec = MCS_FUNCTIONS[name]
+    codes = [spec["handler"], *spec.get("helpers", [])]
+    options = {key: str(value) for key, value in spec.items() if key not in ("handler", "helpers")}
+    constants = {const_name: value for code in codes for const_name, value in referenced_constants(code).items()}
+    content = "".join(inspect.getsource(code) for code in codes) + json.dumps(options, sort_keys=True) \
+        + json.dumps(constants, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def get_deployed_hashes(snf_session: Session, data_db: str, data_schema: str) -> dict:
+    # name -> set of hashes, a function can have multiple overloads
+    rows = snf_session.table(f"{data_db}.INFORMATION_SCHEMA.FUNCTIONS").filter(
+        (F.col("FUNCTION_SCHEMA") == F.lit(data_schema)) & (F.col("FUNCTION_NAME").in_(list(MCS_FUNCTIONS)))) \
+        .select("FUNCTION_NAME", "COMMENT").collect()
+
+    deployed = {}
+    for function_name, comment in rows:
+        if comment and comment.startswith(HASH_COMMENT_PREFIX):
+            deployed.setdefault(function_name, set()).add(comment[len(HASH_COMMENT_PREFIX):])
+        else:
+            deployed.setdefault(function_name, set())
+    return deployed
+
+
+def get_outdated_functions(snf_session: Session, data_db: str, data_schema: str) -> list:
+    deployed = get_deployed_hashes(snf_session, data_db, data_schema)
+    return [name for name in MCS_FUNCTIONS if function_hash(name) not in deployed.get(name, set())]
+
 
 @st.cache_data()
 def check_udfs(data_db: str, data_schema: str):
     snf_session = st.session_state['snowsession']
-    udf_funcs = ['NORM_PPF', 'COLLECT_LIST', 'CALC_CLOSE']
-
-    n_udfs = snf_session.table(f"{data_db}.INFORMATION_SCHEMA.FUNCTIONS").filter(
-        (F.col("FUNCTION_SCHEMA") == F.lit(data_schema)) & (F.col("FUNCTION_NAME").in_(udf_funcs))).count()
 
-    if n_udfs == len(udf_funcs):
+    # Missing functions and functions deployed from other versions of the code need to be deployed
+    if not get_outdated_functions(snf_session, data_db, data_schema):
         st.session_state['install_stage'] = ''
         return True
     else:
         return False
 
+
+def register_function(snf_session: Session, name: str, data_db: str, data_schema: str, stage_loc: str):
+    # The handlers are defined in this module, and the helpers in local_engine, that are not available in Snowflake,
+    # so they need to be pickled by value instead of as a reference to the module
+    cloudpickle.register_pickle_by_value(sys.modules[__name__])
+    cloudpickle.register_pickle_by_value(local_engine)
+    spec = MCS_FUNCTIONS[name]
+    options = {key: value for key, value in spec.items() if key not in ("handler", "helpers")}
+    register = snf_session.udtf.register if "output_schema" in spec else snf_session.udf.register
+    register(spec["handler"], name=f"{data_db}.{data_schema}.{name}", is_permanent=True, replace=True,
+             stage_location=stage_loc, comment=HASH_COMMENT_PREFIX + function_hash(name), **options)
+    return name
+
+
 def deploy_udf():
     snf_session = st.session_state['snowsession']
     data_db = st.session_state['install_db']
@@ -61,61 +432,171 @@ def deploy_udf():
     if n_stages == 0:
         snf_session.sql(f"CREATE STAGE IF NOT EXISTS {stage_name}").collect()
 
-    @F.udf(name=f"{data_db}.{data_schema}.norm_ppf", is_permanent=True, replace=True, packages=["scipy"],
-           stage_location=stage_loc)
-    def norm_ppf(pd_series: T.PandasSeries[float]) -> T.PandasSeries[float]:
-        return norm.ppf(pd_series)
+    # Only register the functions that are missing or changed, in parallel
+    to_deploy = get_outdated_functions(snf_session, data_db, data_schema)
+    if to_deploy:
+        with ThreadPoolExecutor(max_workers=len(to_deploy)) as pool:
+            list(pool.map(lambda name: register_function(snf_session, name, data_db, data_schema, stage_loc),
+                          to_deploy))
 
-    @F.udtf(name=f"{data_db}.{data_schema}.collect_list", is_permanent=True, replace=True
-        , packages=["typing"], output_schema=T.StructType([T.StructField("list", T.ArrayType())])
-        , stage_location=stage_loc)
-    class CollectListHandler:
-        def __init__(self) -> None:
-            self.list = []
+    st.session_state['deploy_report'] = {"deployed": to_deploy,
+                                         "reused": [name for name in MCS_FUNCTIONS if name not in to_deploy]}
+    check_udfs.clear()
+    return True
 
-        def process(self, element: float) -> Iterable[Tuple[list]]:
-            self.list.append(element)
-            yield (self.list,)
 
-    @F.udf(name=f"{data_db}.{data_schema}.calc_close", is_permanent=True, replace=True
-        , packages=["numpy"], stage_location=stage_loc)
-    def calc_return(last_close: float, daily_return: list) -> float:
-        pred_close = last_close * np.prod(daily_return)
-        return float(pred_close)
+class MetadataCatalog:
+    # Keeps the databases and, for each database, all schemas, tables and columns in memory so browsing them
+    # does not need a query for each selection
 
-    return True
+    def __init__(self, snf_session: Session, ttl: int = METADATA_TTL):
+        self.snf_session = snf_session
+        self.ttl = ttl
+        self._databases = None
+        self._databases_loaded = 0.0
+        # db -> (time loaded, {schema: {table: [columns]}})
+        self._db_metadata = {}
+
+    def _expired(self, loaded_at: float) -> bool:
+        return time.time() - loaded_at > self.ttl
+
+    def refresh(self, db: str = None):
+        # Drop the cached metadata for one database, or everything, it is loaded again on next use
+        if db:
+            self._db_metadata.pop(db, None)
+        else:
+            self._databases = None
+            self._db_metadata = {}
+
+    def databases(self) -> list:
+        if self._databases is None or self._expired(self._databases_loaded):
+            self._databases = [dbRow[1] for dbRow in self.snf_session.sql("SHOW DATABASES").collect()]
+            self._databases_loaded = time.time()
+        return self._databases
+
+    def _load(self, db: str) -> dict:
+        # One round trip for all schemas, tables and columns in the database, the left join keeps empty schemas
+        rows = self.snf_session.sql(
+            f"SELECT S.SCHEMA_NAME, C.TABLE_NAME, C.COLUMN_NAME FROM {db}.INFORMATION_SCHEMA.SCHEMATA S LEFT JOIN {db}.INFORMATION_SCHEMA.COLUMNS C ON C.TABLE_CATALOG = S.CATALOG_NAME AND C.TABLE_SCHEMA = S.SCHEMA_NAME WHERE S.CATALOG_NAME = '{db.upper()}' AND S.SCHEMA_NAME != 'INFORMATION_SCHEMA' ORDER BY 1, 2, 3").collect()
+
+        metadata = {}
+        for schema_name, table_name, column_name in rows:
+            tables = metadata.setdefault(schema_name, {})
+            if table_name is not None:
+                tables.setdefault(table_name, []).append(column_name)
+        return metadata
+
+    def metadata(self, db: str) -> dict:
+        if db not in self._db_metadata or self._expired(self._db_metadata[db][0]):
+            self._db_metadata[db] = (time.time(), self._load(db))
+        return self._db_metadata[db][1]
+
+    def schemas(self, db: str) -> list:
+        return list(self.metadata(db).keys())
+
+    def tables(self, db: str, schema: str) -> list:
+        return list(self.metadata(db).get(schema, {}).keys())
+
+    def columns(self, db: str, schema: str, table: str) -> list:
+        return list(self.metadata(db).get(schema, {}).get(table, []))
+
+
+def get_catalog() -> MetadataCatalog:
+    if 'metadata_catalog' not in st.session_state:
+        st.session_state['metadata_catalog'] = MetadataCatalog(st.session_state['snowsession'])
+    return st.session_state['metadata_catalog']
+
+
+def refresh_metadata(db: str = None):
+    get_catalog().refresh(db)
 
 
-@st.cache_data()
 def get_databases():
-    snf_session = st.session_state['snowsession']
-    lst_db = [dbRow[1] for dbRow in snf_session.sql("SHOW DATABASES").collect()]
+    lst_db = list(get_catalog().databases())
     # Add a default None value
     lst_db.insert(0, None)
     return lst_db
 
 
-@st.cache_data()
 def get_schemas(db: str):
-    snf_session = st.session_state['snowsession']
-    lst_schema = [schemaRow[0] for schemaRow in snf_session.sql(
-        f"SELECT SCHEMA_NAME FROM {db}.INFORMATION_SCHEMA.SCHEMATA WHERE CATALOG_NAME = '{db.upper()}' AND SCHEMA_NAME != 'INFORMATION_SCHEMA' ORDER BY 1").collect()]
+    lst_schema = get_catalog().schemas(db)
     lst_schema.insert(0, None)
     return lst_schema
 
 
-@st.cache_data()
 def get_tables(db: str, schema: str):
-    snf_session = st.session_state['snowsession']
-    lst_table = [tableRow[0] for tableRow in snf_session.sql(
-        f"SELECT TABLE_NAME FROM {db}.INFORMATION_SCHEMA.TABLES WHERE TABLE_CATALOG = '{db.upper()}' AND TABLE_SCHEMA='{schema.upper()}' ORDER BY 1").collect()]
+    lst_table = get_catalog().tables(db, schema)
     lst_table.insert(0, None)
     return lst_table
 
 
-@st.cache_data()
 def get_columns(db: str, schema: str, table: str):
+    return get_catalog().columns(db, schema, table)
+
+
+def get_gbm_params(df):
+    def pct_change(indx_col: Column, val_col: Column):
+        return ((val_col - F.lag(val_col, 1).over(Window.orderBy(indx_col))) / F.lag(val_col, 1).over(
+            Window.orderBy(indx_col)))
+
+    # Calculate the log return by day
+    df_log_returns = df.select(F.col("DATE"), F.col("CLOSE")
+                               , F.last_value(F.col("CLOSE")).over(Window.orderBy("DATE")).as_("LAST_CLOSE")
+                               , F.call_function("LN",
+                                                 (F.lit(1) + pct_change(F.col("DATE"), F.col("CLOSE")))).as_(
+            "log_return"))
+
+    # Get the u, var, stddev and last closing price
+    df_params = df_log_returns.select(F.mean("LOG_RETURN").as_("u")
+                                      , F.variance("LOG_RETURN").as_("var")
+                                      , F.stddev("LOG_RETURN").as_("std_dev")
+                                      , F.max(F.col("LAST_CLOSE")).as_("LAST_CLOSE")) \
+        .with_column("drift", (F.col("u") - (F.lit(0.5) * F.col("var")))) \
+        .select("std_dev", "drift", "last_close")
+
+    return df_params
+
+
+def get_table_last_altered(db: str, schema: str, table: str):
     snf_session = st.session_state['snowsession']
-    lst_column = [columnRow[0] for columnRow in snf_session.sql(
-        f"SELECT COLUMN_NAME, DATA_TYPE FROM {db}.INFORMATION_SCHEMA.COLUMNS WHERE TABLE_CATALOG = '{db.upper()}' AND TABLE_SCHEMA='{schema.upper()}' AND TABLE_NAME = '{table.upper()}' ORDER BY 1").collect()]
-    return lst_column
+    rows = snf_session.sql(
+        f"SELECT LAST_ALTERED FROM {db}.INFORMATION_SCHEMA.TABLES WHERE TABLE_CATALOG = '{db.upper()}' AND TABLE_SCHEMA='{schema.upper()}' AND TABLE_NAME = '{table.upper()}'").collect()
+    return rows[0][0] if rows else None
+
+
+def session_identity() -> str:
+    # Account, user and role of the session. Part of the cache key of data cached for the whole process, so users
+    # with different credentials do not get each others data
+    if 'snow_identity' not in st.session_state:
+        row = st.session_state['snowsession'].sql("SELECT CURRENT_ACCOUNT(), CURRENT_USER(), CURRENT_ROLE()").collect()[0]
+        st.session_state['snow_identity'] = ".".join(str(value) for value in row)
+    return st.session_state['snow_identity']
+
+
+def get_closing_stats(db: str, schema: str, table: str, date_col: str, close_col: str, last_altered,
+                      max_points: int = MAX_CHART_POINTS):
+    return load_closing_stats(session_identity(), db, schema, table, date_col, close_col, last_altered, max_points)
+
+
+@st.cache_data()
+def load_closing_stats(identity: str, db: str, schema: str, table: str, date_col: str, close_col: str, last_altered,
+                       max_points: int = MAX_CHART_POINTS):
+    # identity and last_altered are not used in the function, they are part of the cache key so the stats are
+    # cached for each user and role and a changed table is reloaded
+    snf_session = st.session_state['snowsession']
+    df_closing = snf_session.table(f"{db}.{schema}.{table}").select(F.col(date_col).as_("DATE"),
+                                                                     F.col(close_col).as_("CLOSE"))
+    params = get_gbm_params(df_closing).collect()[0]
+
+    # Downsample the chart to max_points by using the last close for each bucket of dates
+    pd_chart = df_closing.with_column("BUCKET", F.ntile(F.lit(max_points)).over(Window.order_by("DATE"))) \
+        .group_by("BUCKET").agg(F.max(F.col("DATE")).as_("DATE")
+                                , F.call_function("MAX_BY", F.col("CLOSE"), F.col("DATE")).as_("CLOSE")
+                                , F.count(F.lit(1)).as_("N_ROWS")) \
+        .sort("DATE").to_pandas()
+
+    return {"ROW_COUNT": int(pd_chart["N_ROWS"].sum()),
+            "CHART": pd_chart[["DATE", "CLOSE"]],
+            # NUMBER columns are returned as Decimal, the local engine needs floats
+            "PARAMS": {"DRIFT": float(params["DRIFT"]), "STD_DEV": float(params["STD_DEV"]),
+                       "LAST_CLOSE": float(params["LAST_CLOSE"])}}
@@ -1,6 +1,7 @@
 # Contents of ~/my_app/pages/page_2.py
 import streamlit as st
-from lib.snf_functions import get_databases, get_schemas, get_tables, get_columns, deploy_udf, check_udfs, connect_to_snf, disconnect_snf
+from lib.snf_functions import get_databases, get_schemas, get_tables, get_columns, deploy_udf, check_udfs, connect_to_snf, disconnect_snf, \
+    renew_snf_session
 
 def dispaly_disconnect():
     st.write("""
@@ -8,12 +9,18 @@ def dispaly_disconnect():
 
     Choose **Run Monte Carlo simulations** in the sidebar to continue.
     """)
+    if 'deploy_report' in st.session_state:
+        deploy_report = st.session_state['deploy_report']
+        st.write("Deployed functions: ", ", ".join(deploy_report["deployed"]) or "-")
+        st.write("Reused functions (unchanged): ", ", ".join(deploy_report["reused"]) or "-")
     with st.form('Snowflake Connection'):
         st.form_submit_button('Disconnect', on_click=disconnect_snf)
 
 st.markdown("# ❄️ Snowflake Connection")
 st.sidebar.markdown("# Snowflake Connection ❄️")
 
+renew_snf_session()
+
 if "snowsession" not in st.session_state:
     with st.form('Snowflake Credentials'):
         st.text_input('Snowflake account', key='snow_account')
@@ -49,7 +56,7 @@ else:
                     dispaly_disconnect()
                 else:
                     st.write("""
-                    The selected database and schema is missing the UDFs needed for doing the Monte Carlo simulations.
+                    The selected database and schema is missing the UDFs needed for doing the Monte Carlo simulations, or they are from an older version of the app.
                     
                     Set the stage name for the internal stage to be used for deployment, if it does not exists it will be created. 
                     """
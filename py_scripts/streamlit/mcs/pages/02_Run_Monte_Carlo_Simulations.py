@@ -1,89 +1,408 @@
 import streamlit as st
+import pandas as pd
+import numpy as np
+import uuid
 
 import snowflake.snowpark.functions as F
-from snowflake.snowpark import Column, Window
+import snowflake.snowpark.types as T
+from snowflake.snowpark import Window
 
-from lib.snf_functions import get_databases, get_schemas, get_tables, get_columns, deploy_udf
+from lib.snf_functions import get_databases, get_schemas, get_tables, get_columns, deploy_udf, get_gbm_params, \
+    get_table_last_altered, get_closing_stats, refresh_metadata, normal_draw, NORMAL_SAMPLERS, renew_snf_session
+from lib import local_engine
 
 import plotly.express as px
+import plotly.graph_objects as go
 
-# Get the current credentials
+# Get the current credentials, a session not used for a long time has been reclaimed by the session pool
+renew_snf_session()
 if "snowsession" in st.session_state:
     snf_session = st.session_state['snowsession']
 else:
     st.write("**Please log into you Snowflake account first!**")
     st.stop()
-def run_simulations(df, n_days, n_sim_runs):
-    def pct_change(indx_col: Column, val_col: Column):
-        return ((val_col - F.lag(val_col, 1).over(Window.orderBy(indx_col))) / F.lag(val_col, 1).over(
-            Window.orderBy(indx_col)))
-
-    # Calculate the log return by day
-    df_log_returns = df_closing.select(F.col("DATE"), F.col("CLOSE")
-                                       , F.last_value(F.col("CLOSE")).over(Window.orderBy("DATE")).as_("LAST_CLOSE")
-                                       , F.call_function("LN",
-                                                         (F.lit(1) + pct_change(F.col("DATE"), F.col("CLOSE")))).as_(
-            "log_return"))
-
-    # Get the u, var, stddev and last closing price
-    df_params = df_log_returns.select(F.mean("LOG_RETURN").as_("u")
-                                      , F.variance("LOG_RETURN").as_("var")
-                                      , F.stddev("LOG_RETURN").as_("std_dev")
-                                      , F.max(F.col("LAST_CLOSE")).as_("LAST_CLOSE")) \
-        .with_column("drift", (F.col("u") - (F.lit(0.5) * F.col("var")))) \
-        .select("std_dev", "drift", "last_close")
+
+if "install_schema" not in st.session_state:
+    st.write("**Please select the database and schema with the Monte Carlo Simulation UDFs first!**")
+    st.stop()
+data_db = st.session_state['install_db']
+data_schema = st.session_state['install_schema']
+
+# The ways SIM_CLOSE can be calculated, label shown in the sidebar -> method name
+PATH_METHODS = {"Vectorized GBM_PATHS UDTF": "udtf", "Cumulative sum (EXP(SUM(LN)))": "cumulative",
+                "COLLECT_LIST UDTF": "collect_list"}
+
+# Number of simulation runs generated by each GBM_PATHS partition
+RUNS_PER_PARTITION = 100
+
+# Number of simulation runs drawn as lines in the summary chart
+N_SAMPLE_PATHS = 10
+
+# Number of simulation runs in each batch when running until the expected price has converged, a multiple of
+# SOBOL_BLOCK_RUNS so antithetic pairs and Sobol blocks are never split between batches
+ADAPTIVE_BATCH_RUNS = 8 * local_engine.SOBOL_BLOCK_RUNS
+
+# Ways the number of simulations is decided, label shown in the sidebar -> run mode
+RUN_MODES = {"Fixed number of simulations": "fixed", "Until the expected price and quantiles have converged": "adaptive"}
+
+
+def params_dataframe(params):
+    # A one row DataFrame with the GBM parameters, so they do not need to be calculated again
+    return snf_session.create_dataframe([[params["STD_DEV"], params["DRIFT"], params["LAST_CLOSE"]]],
+                                        schema=["STD_DEV", "DRIFT", "LAST_CLOSE"])
+
+
+def sim_run_generator(n_sim_runs, first_run=1):
+    return snf_session.generator((F.row_number().over(Window.order_by(F.seq4())) + F.lit(first_run - 1)).as_("sim_run"),
+                                 rowcount=n_sim_runs)
+
+
+def simulate_daily_returns(df_params, n_days, n_sim_runs, seed=None, sampler="norm_ppf_fast", sampling="random"):
+    if sampling == "sobol":
+        raise ValueError("Sobol sampling needs the GBM_PATHS UDTF or the local backend")
 
     # Generates rows for the number of days and simulations by day
     df_days = snf_session.generator(F.row_number().over(Window.order_by(F.seq4())).as_("day_id"), rowcount=n_days)
-    df_sim_runs = snf_session.generator(F.row_number().over(Window.order_by(F.seq4())).as_("sim_run"),
-                                        rowcount=n_sim_runs)
+    df_sim_runs = sim_run_generator(n_sim_runs)
+
+    if sampling == "antithetic":
+        # Draw Z for half of the runs, run 2k-1 uses Z and run 2k uses -Z
+        df_draws = df_days.join(sim_run_generator((n_sim_runs + 1) // 2).with_column_renamed("SIM_RUN", "DRAW_ID")) \
+            .select("day_id", "DRAW_ID", normal_draw(sampler, data_db, data_schema, seed).as_("Z"))
+        df_z = df_draws.join_table_function("flatten", F.array_construct(F.col("Z"), -F.col("Z"))) \
+            .select("day_id", (F.col("DRAW_ID") * F.lit(2) - F.lit(1) + F.col("INDEX")).as_("SIM_RUN")
+                    , F.col("VALUE").cast(T.FloatType()).as_("Z")) \
+            .filter(F.col("SIM_RUN") <= F.lit(n_sim_runs))
+    else:
+        df_z = df_days.join(df_sim_runs).select("day_id", "sim_run"
+                                                , normal_draw(sampler, data_db, data_schema, seed).as_("Z"))
 
-    df_daily_returns = df_days.join(df_sim_runs).join(df_params) \
-        .select("day_id", "sim_run"
-                , F.exp(F.col("drift") + F.col("std_dev") * F.call_function(f"{data_db}.{data_schema}.norm_ppf",
-                                                                            F.uniform(0.0, 1.0, F.random()))).as_(
-            "daily_return")
-                , F.lit(None).as_("SIM_CLOSE")) \
-        .sort(F.col("DAY_ID"), F.col("sim_run"))
+    # The log of the daily return, ie drift + std_dev * Z, the daily return is EXP(LOG_RETURN)
+    df_daily_returns = df_z.join(df_params) \
+        .select("day_id", "sim_run", (F.col("drift") + F.col("std_dev") * F.col("Z")).as_("LOG_RETURN")
+                , F.col("LAST_CLOSE").as_("SIM_CLOSE_0"))
 
     # Generate a day 0 row with the last closing price for each simulation run
-    last_close = df_params.select("LAST_CLOSE").collect()[0][0]
-    df_day_0 = snf_session.generator(F.lit(0).as_("DAY_ID"),
-                                     F.row_number().over(Window.order_by(F.seq4())).as_("SIM_RUN")
-                                     , F.lit(1.0).as_("DAILY_RETURN"), F.lit(last_close).as_("SIM_CLOSE"),
-                                     rowcount=n_sim_runs)
+    df_day_0 = df_sim_runs.join(df_params).select(F.lit(0).as_("DAY_ID"), "SIM_RUN", F.lit(0.0).as_("LOG_RETURN")
+                                                  , F.col("LAST_CLOSE").as_("SIM_CLOSE_0"))
 
     # Union the dataframes,
-    df_simulations = df_day_0.union_all(df_daily_returns)
+    return df_day_0.union_all(df_daily_returns)
+
+
+def paths_collect_list(df_returns):
+    # Collect all daily returns up to the current day and multiply them, grows with the number of days per row
+    df_sim_close_input = df_returns.with_column("L_DAILY_RETURN",
+                                                F.call_table_function(f"{data_db}.{data_schema}.collect_list",
+                                                                      F.exp(F.col("LOG_RETURN"))).over(
+                                                    partition_by="SIM_RUN", order_by="DAY_ID"))
+
+    return df_sim_close_input.with_column("SIM_CLOSE", F.call_function(f"{data_db}.{data_schema}.calc_close"
+                                                                       , F.col("SIM_CLOSE_0"),
+                                                                       F.col("L_DAILY_RETURN")))
+
 
-    df_simulations_calc_input = df_simulations.with_column("SIM_CLOSE_0", F.first_value(F.col("SIM_CLOSE")).over(
-        Window.partition_by("SIM_RUN").order_by("DAY_ID"))) \
-        .with_column("L_DAILY_RETURN",
-                     F.call_table_function(f"{data_db}.{data_schema}.collect_list", F.col("DAILY_RETURN")).over(
-                         partition_by="SIM_RUN", order_by="DAY_ID"))
+def paths_cumulative(df_returns):
+    # prod(daily_return) = EXP(SUM(LN(daily_return))), a running sum only needs the previous value for each row
+    window = Window.partition_by("SIM_RUN").order_by("DAY_ID") \
+        .rows_between(Window.UNBOUNDED_PRECEDING, Window.CURRENT_ROW)
+    return df_returns.with_column("SIM_CLOSE", F.col("SIM_CLOSE_0") * F.exp(F.sum(F.col("LOG_RETURN")).over(window)))
 
-    df_sim_close = df_simulations_calc_input.with_column("SIM_CLOSE",
-                                                         F.call_function(f"{data_db}.{data_schema}.calc_close"
-                                                                         , F.col("SIM_CLOSE_0"),
-                                                                         F.col("L_DAILY_RETURN")))
+
+PATH_BUILDERS = {"cumulative": paths_cumulative, "collect_list": paths_collect_list}
+
+
+def paths_udtf(df_params, n_days, n_sim_runs, seed=None, sampling="random", first_run=1):
+    # One row for each simulation run, GBM_PATHS generates the whole path for all runs in a partition at once
+    df_runs = sim_run_generator(n_sim_runs, first_run).join(df_params) \
+        .with_column("PARTITION_ID", F.floor((F.col("SIM_RUN") - F.lit(1)) / F.lit(RUNS_PER_PARTITION)))
+
+    return df_runs.select(F.call_table_function(f"{data_db}.{data_schema}.gbm_paths"
+                                                , F.col("SIM_RUN"), F.col("DRIFT"), F.col("STD_DEV")
+                                                , F.col("LAST_CLOSE"), F.lit(n_days)
+                                                , F.lit(seed).cast(T.LongType()), F.lit(sampling))
+                          .over(partition_by="PARTITION_ID"))
+
+
+def run_simulations_snf(df, n_days, n_sim_runs, path_method="udtf", seed=None, params=None,
+                        sampler="norm_ppf_fast", sampling="random"):
+    df_params = params_dataframe(params) if params else get_gbm_params(df)
+    seed = local_engine.resolve_seed(seed, sampling)
+    if path_method == "udtf":
+        df_sim_close = paths_udtf(df_params, n_days, n_sim_runs, seed, sampling)
+    else:
+        df_returns = simulate_daily_returns(df_params, n_days, n_sim_runs, seed, sampler, sampling)
+        df_sim_close = PATH_BUILDERS[path_method](df_returns)
 
     # Cache the returning Snowpark Dataframe so we do not run it multiple times when visulazing etc
     return df_sim_close.select("DAY_ID", "SIM_RUN", "SIM_CLOSE").cache_result()
 
 
-def display_sim_result(df):
-    pd_simulations = df.sort("DAY_ID", "SIM_RUN").to_pandas()
+# Backends that can run the simulations, label shown in the sidebar -> backend name
+SIM_BACKENDS = {"Snowflake": "snowflake", "Local (NumPy)": "local"}
+BACKEND_FUNCS = {"snowflake": run_simulations_snf, "local": local_engine.run_simulations}
+
+
+def run_simulations(df, n_days, n_sim_runs, backend="snowflake", **kwargs):
+    # All backends returns the DAY_ID, SIM_RUN and SIM_CLOSE columns, Snowflake as a Snowpark DataFrame
+    # and local as a pandas DataFrame
+    return BACKEND_FUNCS[backend](df, n_days, n_sim_runs, **kwargs)
+
+
+def compare_path_methods(df, n_days, n_sim_runs, path_method, seed=None, params=None, sampler="norm_ppf_fast",
+                         sampling="random"):
+    df_params = params_dataframe(params) if params else get_gbm_params(df)
+    if path_method == "udtf":
+        # Derive the daily returns from the generated paths so COLLECT_LIST can rebuild the same paths
+        df_new = paths_udtf(df_params, n_days, n_sim_runs, seed, sampling).cache_result()
+        window = Window.partition_by("SIM_RUN").order_by("DAY_ID")
+        df_returns = df_new.select("DAY_ID", "SIM_RUN"
+                                   , F.coalesce(F.call_function("LN", F.col("SIM_CLOSE")
+                                                                / F.lag(F.col("SIM_CLOSE")).over(window)),
+                                                F.lit(0.0)).as_("LOG_RETURN")
+                                   , F.first_value(F.col("SIM_CLOSE")).over(window).as_("SIM_CLOSE_0"))
+    else:
+        # Materialize the daily returns once so both methods use the same random numbers
+        df_returns = simulate_daily_returns(df_params, n_days, n_sim_runs, seed, sampler, sampling).cache_result()
+        df_new = PATH_BUILDERS[path_method](df_returns)
+
+    df_new = df_new.select("DAY_ID", "SIM_RUN", F.col("SIM_CLOSE").as_("NEW_CLOSE"))
+    df_current = paths_collect_list(df_returns).select("DAY_ID", "SIM_RUN", F.col("SIM_CLOSE").as_("CURRENT_CLOSE"))
+
+    diff = df_new.join(df_current, ["DAY_ID", "SIM_RUN"]) \
+        .select(F.count(F.lit(1)).as_("N_ROWS")
+                , F.max(F.abs(F.col("NEW_CLOSE") - F.col("CURRENT_CLOSE")) / F.col("CURRENT_CLOSE")).as_(
+            "MAX_REL_DIFF")).collect()
+    return diff[0]["N_ROWS"], diff[0]["MAX_REL_DIFF"]
+
+
+def get_sim_summary(df, n_sample_paths=N_SAMPLE_PATHS):
+    # Returns one pandas DataFrame with ROW_TYPE:
+    #   BAND   - mean and P5/P50/P95 for each day
+    #   METRIC - mean and P5/P50/P95 over all simulated prices
+    #   PATH   - the simulated prices for the first n_sample_paths runs, since the runs are independent those
+    #            are as good of a sample as any
+    if isinstance(df, pd.DataFrame):
+        # Result from the local backend
+        def quantiles(sim_close):
+            return pd.Series({"MEAN": sim_close.mean(), "P5": sim_close.quantile(0.05),
+                              "P50": sim_close.quantile(0.5), "P95": sim_close.quantile(0.95)})
+
+        pd_bands = df.groupby("DAY_ID")["SIM_CLOSE"].apply(quantiles).unstack().reset_index()
+        pd_metrics = quantiles(df["SIM_CLOSE"]).round(2).to_frame().T
+        pd_paths = df[df["SIM_RUN"] <= n_sample_paths][["DAY_ID", "SIM_RUN", "SIM_CLOSE"]]
+        return pd.concat([pd_bands.assign(ROW_TYPE="BAND"), pd_metrics.assign(ROW_TYPE="METRIC"),
+                          pd_paths.assign(ROW_TYPE="PATH")], ignore_index=True)
+
+    def quantiles():
+        return [F.mean(F.col("SIM_CLOSE")).as_("MEAN")
+                , F.percentile_cont(0.05).within_group("SIM_CLOSE").as_("P5")
+                , F.percentile_cont(0.5).within_group("SIM_CLOSE").as_("P50")
+                , F.percentile_cont(0.95).within_group("SIM_CLOSE").as_("P95")]
+
+    no_run = F.lit(None).cast(T.LongType()).as_("SIM_RUN")
+    no_close = F.lit(None).cast(T.FloatType()).as_("SIM_CLOSE")
+    df_bands = df.group_by("DAY_ID").agg(*quantiles()) \
+        .select(F.lit("BAND").as_("ROW_TYPE"), "DAY_ID", no_run, "MEAN", "P5", "P50", "P95", no_close)
+    df_metrics = df.agg(*quantiles()) \
+        .select(F.lit("METRIC").as_("ROW_TYPE"), F.lit(None).cast(T.LongType()).as_("DAY_ID"), no_run
+                , *[F.round(F.col(c), 2).as_(c) for c in ["MEAN", "P5", "P50", "P95"]], no_close)
+    df_paths = df.filter(F.col("SIM_RUN") <= F.lit(n_sample_paths)) \
+        .select(F.lit("PATH").as_("ROW_TYPE"), "DAY_ID", "SIM_RUN"
+                , *[F.lit(None).cast(T.FloatType()).as_(c) for c in ["MEAN", "P5", "P50", "P95"]], "SIM_CLOSE")
+
+    # Everything is returned in one round trip
+    return df_bands.union_all(df_metrics).union_all(df_paths).to_pandas()
+
+
+def bands_figure(pd_bands, pd_paths=None):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=pd_bands["DAY_ID"], y=pd_bands["P95"], line=dict(width=0), showlegend=False,
+                             name="Quantile (95%)"))
+    fig.add_trace(go.Scatter(x=pd_bands["DAY_ID"], y=pd_bands["P5"], line=dict(width=0), fill="tonexty",
+                             name="Quantile (5% - 95%)"))
+    if pd_paths is not None:
+        for sim_run, pd_path in pd_paths.groupby("SIM_RUN"):
+            fig.add_trace(go.Scatter(x=pd_path["DAY_ID"], y=pd_path["SIM_CLOSE"], mode="lines", opacity=0.4,
+                                     line=dict(width=1), showlegend=False, name=f"Simulation {int(sim_run)}"))
+    fig.add_trace(go.Scatter(x=pd_bands["DAY_ID"], y=pd_bands["P50"], mode="lines", name="Median"))
+    fig.add_trace(go.Scatter(x=pd_bands["DAY_ID"], y=pd_bands["MEAN"], mode="lines", name="Mean"))
+    return fig
+
+
+def display_sim_summary(df):
+    pd_summary = get_sim_summary(df)
+    pd_bands = pd_summary[pd_summary["ROW_TYPE"] == "BAND"].sort_values("DAY_ID")
+    pd_paths = pd_summary[pd_summary["ROW_TYPE"] == "PATH"].sort_values(["SIM_RUN", "DAY_ID"])
+    metrics = pd_summary[pd_summary["ROW_TYPE"] == "METRIC"].iloc[0]
+
+    st.plotly_chart(bands_figure(pd_bands, pd_paths), use_container_width=True)
+
+    st.write("Expected price: ", metrics["MEAN"])
+    st.write(f"Quantile (5%): ", metrics["P5"])
+    st.write(f"Quantile (50%): ", metrics["P50"])
+    st.write(f"Quantile (95%): ", metrics["P95"])
+
+
+def display_sim_result(df, summary=True):
+    if summary:
+        display_sim_summary(df)
+        return
+
+    if isinstance(df, pd.DataFrame):
+        # Result from the local backend
+        pd_simulations = df.sort_values(["DAY_ID", "SIM_RUN"])
+        sim_close = pd_simulations["SIM_CLOSE"]
+        metrics = [[round(sim_close.mean(), 2), round(sim_close.quantile(0.05), 2),
+                    round(sim_close.quantile(0.95), 2)]]
+    else:
+        pd_simulations = df.sort("DAY_ID", "SIM_RUN").to_pandas()
+        metrics = df.select(F.round(F.mean(F.col("SIM_CLOSE")), 2)
+                            , F.round(F.percentile_cont(0.05).within_group("SIM_CLOSE"), 2)
+                            , F.round(F.percentile_cont(0.95).within_group("SIM_CLOSE"), 2)).collect()
 
     fig = px.line(pd_simulations, x="DAY_ID", y="SIM_CLOSE", color='SIM_RUN', render_mode='svg')
     st.plotly_chart(fig, use_container_width=True)
-    metrics = df.select(F.round(F.mean(F.col("SIM_CLOSE")), 2)
-                        , F.round(F.percentile_cont(0.05).within_group("SIM_CLOSE"), 2)
-                        , F.round(F.percentile_cont(0.95).within_group("SIM_CLOSE"), 2)).collect()
     st.write("Expected price: ", metrics[0][0])
     st.write(f"Quantile (5%): ", metrics[0][1])
     st.write(f"Quantile (95%): ", metrics[0][2])
 
 
+def simulate_batch_snf(df_params, n_days, first_run, n_runs, seed, sampling, paths_table, sketch_table):
+    # Appends the paths of the batch to paths_table and a t-digest state for each day to sketch_table, the
+    # states can be combined so the quantiles over all batches never needs to read all paths again
+    paths_udtf(df_params, n_days, n_runs, seed, sampling, first_run).write.mode("append") \
+        .save_as_table(paths_table, table_type="temporary")
+    df_batch = snf_session.table(paths_table).filter(F.col("SIM_RUN").between(first_run, first_run + n_runs - 1))
+    df_batch.group_by("DAY_ID").agg(F.count(F.lit(1)).as_("N"), F.sum(F.col("SIM_CLOSE")).as_("SUM_CLOSE")
+                                    , F.call_function("APPROX_PERCENTILE_ACCUMULATE", F.col("SIM_CLOSE")).as_("STATE")) \
+        .write.mode("append").save_as_table(sketch_table, table_type="temporary")
+
+    return df_batch.filter(F.col("DAY_ID") == F.lit(n_days)).select("SIM_RUN", "SIM_CLOSE").to_pandas()
+
+
+def get_sketch_bands(sketch_table):
+    def estimate(q):
+        return F.call_function("APPROX_PERCENTILE_ESTIMATE"
+                               , F.call_function("APPROX_PERCENTILE_COMBINE", F.col("STATE")), F.lit(q))
+
+    return snf_session.table(sketch_table).group_by("DAY_ID") \
+        .agg((F.sum(F.col("SUM_CLOSE")) / F.sum(F.col("N"))).as_("MEAN"), estimate(0.05).as_("P5")
+             , estimate(0.5).as_("P50"), estimate(0.95).as_("P95")).to_pandas()
+
+
+def run_until_converged(n_days, tolerance, max_sim_runs, seed=None, params=None, sampling="random",
+                        backend="snowflake"):
+    # Runs batches of simulations until the 95% confidence interval of the expected price is within +/- tolerance
+    # and the P5 and P95 of the last day have changed less than the tolerance since the previous batch, the chart
+    # is updated after each batch. Returns the simulations and the number of simulation runs
+    placeholder = st.empty()
+    if backend == "snowflake":
+        df_params = params_dataframe(params)
+        table_id = uuid.uuid4().hex[:8].upper()
+        paths_table = f"{data_db}.{data_schema}.MCS_PATHS_{table_id}"
+        sketch_table = f"{data_db}.{data_schema}.MCS_SKETCH_{table_id}"
+    else:
+        # Each batch is added to the summary and not kept, like the sketches of the Snowflake backend
+        summary = local_engine.SimulationSummary(params, n_days, N_SAMPLE_PATHS)
+
+    estimate = local_engine.ExpectedPrice(sampling)
+    prev_quantiles = None
+    first_run = 1
+    while first_run <= max_sim_runs:
+        n_runs = min(ADAPTIVE_BATCH_RUNS, max_sim_runs - first_run + 1)
+        if backend == "snowflake":
+            pd_final = simulate_batch_snf(df_params, n_days, first_run, n_runs, seed, sampling, paths_table,
+                                          sketch_table)
+            pd_bands = get_sketch_bands(sketch_table)
+        else:
+            pd_batch = local_engine.simulate_chunk(params, n_days, first_run, n_runs, seed, sampling=sampling)
+            summary.add(pd_batch)
+            pd_final = pd_batch[pd_batch["DAY_ID"] == n_days]
+            pd_bands = summary.bands()
+        first_run += n_runs
+
+        estimate.add(pd_final["SIM_RUN"], pd_final["SIM_CLOSE"].astype(float))
+        n_paths, expected_price, std_error = estimate.estimate()
+        # The tail quantiles of the last day, the widest band, compared with the previous batch
+        pd_last_day = pd_bands[pd_bands["DAY_ID"] == n_days].iloc[0]
+        quantiles = np.array([pd_last_day["P5"], pd_last_day["P95"]], dtype=float)
+        quantile_change = np.abs(quantiles - prev_quantiles).max() if prev_quantiles is not None else np.inf
+        prev_quantiles = quantiles
+
+        with placeholder.container():
+            st.plotly_chart(bands_figure(pd_bands.sort_values("DAY_ID")), use_container_width=True)
+            st.write(f"{n_paths} simulations, expected price: {expected_price:.2f} +/- {1.96 * std_error:.4f}, "
+                     f"change of P5/P95 since the previous batch: {quantile_change:.4f}")
+        if 1.96 * std_error <= tolerance and quantile_change <= tolerance:
+            break
+
+    if backend == "snowflake":
+        return snf_session.table(paths_table), first_run - 1
+    # The local backend only keeps the sample paths and the last day of each simulation run
+    pd_simulations = pd.concat(summary.paths + [summary.final_close().assign(DAY_ID=n_days)], ignore_index=True)
+    return pd_simulations[["DAY_ID", "SIM_RUN", "SIM_CLOSE"]].drop_duplicates(["DAY_ID", "SIM_RUN"]), first_run - 1
+
+
+def display_convergence_report(df, n_days, sampling="random", target_std_error=0.0):
+    # Only the prices on the last day are needed, one row per simulation run
+    if isinstance(df, pd.DataFrame):
+        pd_final = df[df["DAY_ID"] == n_days]
+    else:
+        pd_final = df.filter(F.col("DAY_ID") == F.lit(n_days)).select("SIM_RUN", "SIM_CLOSE").to_pandas()
+
+    pd_report = local_engine.convergence_report(pd_final["SIM_RUN"], pd_final["SIM_CLOSE"].astype(float), sampling)
+    st.subheader("Convergence of the expected price")
+    if pd_report.empty:
+        st.write("Too few simulations to calculate the standard error.")
+        return
+
+    st.line_chart(pd_report, x="N_PATHS", y="STD_ERROR")
+    st.dataframe(pd_report.round(4).set_index("N_PATHS"))
+    last = pd_report.iloc[-1]
+    if target_std_error > 0:
+        # The standard error shrinks with 1 / sqrt(number of paths)
+        n_needed = int(np.ceil(last["N_PATHS"] * (last["STD_ERROR"] / target_std_error) ** 2))
+        st.write(f"Simulations needed for a standard error of {target_std_error}: ", n_needed)
+
+
+def save_simulations_run(df, table_name, run_info):
+    # Appends the simulations as a new run to table_name, clustered by RUN_ID, and adds one row with the
+    # parameters and final day metrics for the run to <table_name>_RUNS
+    runs_table_name = f"{table_name}_RUNS"
+    snf_session.sql(f"CREATE TABLE IF NOT EXISTS {table_name} (RUN_ID VARCHAR, RUN_TS TIMESTAMP_LTZ, DAY_ID NUMBER"
+                    f", SIM_RUN NUMBER, SIM_CLOSE FLOAT) CLUSTER BY (RUN_ID)").collect()
+    snf_session.sql(f"CREATE TABLE IF NOT EXISTS {runs_table_name} (RUN_ID VARCHAR, RUN_TS TIMESTAMP_LTZ"
+                    f", SOURCE_TABLE VARCHAR, DATE_COLUMN VARCHAR, CLOSE_COLUMN VARCHAR, N_DAYS NUMBER"
+                    f", N_SIM_RUNS NUMBER, SEED NUMBER, BACKEND VARCHAR, PATH_METHOD VARCHAR, SAMPLING VARCHAR"
+                    f", LAST_CLOSE FLOAT, DRIFT FLOAT, STD_DEV FLOAT, EXPECTED_PRICE FLOAT, P5 FLOAT, P50 FLOAT"
+                    f", P95 FLOAT)").collect()
+
+    run_id = uuid.uuid4().hex
+    run_ts = snf_session.sql("SELECT CURRENT_TIMESTAMP()").collect()[0][0]
+
+    df.select(F.lit(run_id).as_("RUN_ID"), F.lit(run_ts).as_("RUN_TS"), "DAY_ID", "SIM_RUN", "SIM_CLOSE") \
+        .write.mode("append").save_as_table(table_name, column_order="name")
+
+    params = run_info["params"]
+    df.filter(F.col("DAY_ID") == F.lit(run_info["n_days"])) \
+        .agg(F.mean(F.col("SIM_CLOSE")).as_("EXPECTED_PRICE")
+             , F.percentile_cont(0.05).within_group("SIM_CLOSE").as_("P5")
+             , F.percentile_cont(0.5).within_group("SIM_CLOSE").as_("P50")
+             , F.percentile_cont(0.95).within_group("SIM_CLOSE").as_("P95")) \
+        .select(F.lit(run_id).as_("RUN_ID"), F.lit(run_ts).as_("RUN_TS")
+                , F.lit(run_info["source_table"]).as_("SOURCE_TABLE"), F.lit(run_info["date_column"]).as_("DATE_COLUMN")
+                , F.lit(run_info["close_column"]).as_("CLOSE_COLUMN"), F.lit(run_info["n_days"]).as_("N_DAYS")
+                , F.lit(run_info["n_sim_runs"]).as_("N_SIM_RUNS"), F.lit(run_info["seed"]).cast(T.LongType()).as_("SEED")
+                , F.lit(run_info["backend"]).as_("BACKEND"), F.lit(run_info["path_method"]).as_("PATH_METHOD")
+                , F.lit(run_info["sampling"]).as_("SAMPLING")
+                , F.lit(params["LAST_CLOSE"]).as_("LAST_CLOSE"), F.lit(params["DRIFT"]).as_("DRIFT")
+                , F.lit(params["STD_DEV"]).as_("STD_DEV"), "EXPECTED_PRICE", "P5", "P50", "P95") \
+        .write.mode("append").save_as_table(runs_table_name, column_order="name")
+
+    return run_id
+
+
 # Write directly to the app
 st.sidebar.markdown("# Simulation Parameters")
 st.title("Monte Carlo Simulations :balloon:")
@@ -93,7 +412,28 @@ with st.sidebar:
     with st.form(key="simulation_param"):
         n_days = st.slider('Number of Days to Generate', 1, 1000, 100)
         n_iterations = st.slider('Number of Simulations by Day', 1, 100, 20)
+        sel_backend = st.selectbox('Run simulations in', list(SIM_BACKENDS.keys()))
+        sel_path_method = st.selectbox('Path generation (Snowflake)', list(PATH_METHODS.keys()))
+        sel_sampler = st.selectbox('Normal distribution sampler (SQL path generation)', list(NORMAL_SAMPLERS.keys()))
+        sel_sampling = st.selectbox('Sampling', list(local_engine.SAMPLING_METHODS.keys()),
+                                    help="Sobol is not supported by the SQL path generation, the GBM_PATHS UDTF is "
+                                         "used instead")
+        target_std_error = st.number_input('Target standard error of the expected price (0 = none)', min_value=0.0,
+                                           value=0.0)
+        seed = st.number_input('Random seed (0 = no seed)', min_value=0, value=0, step=1)
+        sel_run_mode = st.radio('Number of simulations', list(RUN_MODES.keys()),
+                                help="Until converged runs batches of simulations, using the GBM_PATHS UDTF in "
+                                     "Snowflake, until the 95% confidence interval of the expected price is "
+                                     "within the tolerance and the P5/P95 of the last day changes less than the "
+                                     "tolerance between two batches. The local backend only keeps the sample "
+                                     "paths and the last day of each simulation")
+        tolerance = st.number_input('Tolerance of the expected price and P5/P95 (+/-)', min_value=0.0, value=0.5)
+        max_sim_runs = st.number_input('Max number of simulations', min_value=ADAPTIVE_BATCH_RUNS, value=10000,
+                                       step=ADAPTIVE_BATCH_RUNS)
+        check_paths = st.checkbox('Compare with the COLLECT_LIST path generation (Snowflake)')
+        show_all_paths = st.checkbox('Plot all simulation paths (slow for many simulations)')
         st.session_state.start_sim_clicked = st.form_submit_button(label="Run Simulations")
+    st.button("Refresh database metadata", on_click=refresh_metadata)
 
 lst_databases = get_databases()
 col1, col2, col3, col4 = st.columns(4)
@@ -122,14 +462,51 @@ sel_columns = col4.multiselect("Columns", lst_columns, max_selections=2)
 if len(sel_columns) == 2:
     df_closing = snf_session.table(f"{sel_db}.{sel_schema}.{sel_table}").select(F.col(sel_columns[0]).as_("DATE"),
                                                                                 F.col(sel_columns[1]).as_("CLOSE"))
-    st.write(df_closing.count())
-    st.line_chart(df_closing.to_pandas(), x="DATE", y="CLOSE")
+    # Only reloaded when another table/columns are selected or the table has been changed
+    last_altered = get_table_last_altered(sel_db, sel_schema, sel_table)
+    closing_stats = get_closing_stats(sel_db, sel_schema, sel_table, sel_columns[0], sel_columns[1], last_altered)
+    st.write(closing_stats["ROW_COUNT"])
+    st.line_chart(closing_stats["CHART"], x="DATE", y="CLOSE")
 
 if st.session_state.start_sim_clicked:
     with st.spinner('Running simulations...'):
-        df_simulations = run_simulations(df_closing, n_days, n_iterations)
-        display_sim_result(df_simulations)
+        backend = SIM_BACKENDS[sel_backend]
+        path_method = PATH_METHODS[sel_path_method]
+        sampling = local_engine.SAMPLING_METHODS[sel_sampling]
+        if sampling == "sobol" and path_method != "udtf":
+            path_method = "udtf"
+        # Resolved here so the same seed is used for the comparison and saved with the run
+        sim_seed = local_engine.resolve_seed(int(seed) if seed else None, sampling)
+        if RUN_MODES[sel_run_mode] == "adaptive":
+            if backend == "snowflake":
+                path_method = "udtf"
+            df_simulations, n_sim_runs = run_until_converged(n_days, tolerance, int(max_sim_runs), sim_seed,
+                                                             closing_stats["PARAMS"], sampling, backend)
+        else:
+            n_sim_runs = n_iterations
+            if backend == "snowflake":
+                df_simulations = run_simulations(df_closing, n_days, n_sim_runs, backend, path_method=path_method,
+                                                 seed=sim_seed, params=closing_stats["PARAMS"],
+                                                 sampler=NORMAL_SAMPLERS[sel_sampler], sampling=sampling)
+            else:
+                df_simulations = run_simulations(df_closing, n_days, n_sim_runs, backend, seed=sim_seed,
+                                                 params=closing_stats["PARAMS"], sampling=sampling)
+            display_sim_result(df_simulations, summary=not show_all_paths)
+        display_convergence_report(df_simulations, n_days, sampling, target_std_error)
+        if check_paths and backend == "snowflake":
+            n_rows, max_rel_diff = compare_path_methods(df_closing, n_days, n_sim_runs, path_method, sim_seed,
+                                                        closing_stats["PARAMS"], NORMAL_SAMPLERS[sel_sampler],
+                                                        sampling)
+            st.write(f"Compared {n_rows} rows with the COLLECT_LIST path generation, max relative difference: ",
+                     max_rel_diff)
         st.session_state["df"] = df_simulations
+        st.session_state["run_info"] = {"source_table": f"{sel_db}.{sel_schema}.{sel_table}",
+                                        "date_column": sel_columns[0], "close_column": sel_columns[1],
+                                        "n_days": n_days, "n_sim_runs": n_sim_runs, "seed": sim_seed,
+                                        "backend": backend,
+                                        "path_method": path_method if backend == "snowflake" else None,
+                                        "sampling": sampling,
+                                        "params": closing_stats["PARAMS"]}
         st.session_state.start_sim_clicked = False
 
 if "df" in st.session_state:
@@ -148,11 +525,20 @@ if "df" in st.session_state:
         have_schema = True
 
     save_tbl = st.text_input(label="Table name", value="STOCK_PRICE_SIMULATIONS", disabled=have_schema)
+    save_mode = st.radio("Save mode", ["Append as a new run", "Overwrite"], horizontal=True,
+                         help="Append keeps earlier runs, with a summary of each run in the <table name>_RUNS table")
     save = st.button("❄️ Save results", key="save_sims")
     if save:
         df_simulations = st.session_state["df"]
-        display_sim_result(df_simulations)
+        display_sim_result(df_simulations, summary=not show_all_paths)
+        if isinstance(df_simulations, pd.DataFrame):
+            df_simulations = snf_session.create_dataframe(df_simulations)
         with st.spinner("Saving data..."):
-            df_simulations.write.mode('overwrite').save_as_table(f"{save_db}.{save_schema}.{save_tbl}")
-            st.success(f"✅ Successfully wrote simulations to {save_db}.{save_schema}.{save_tbl}!")
+            if save_mode == "Overwrite":
+                df_simulations.write.mode('overwrite').save_as_table(f"{save_db}.{save_schema}.{save_tbl}")
+                st.success(f"✅ Successfully wrote simulations to {save_db}.{save_schema}.{save_tbl}!")
+            else:
+                run_id = save_simulations_run(df_simulations, f"{save_db}.{save_schema}.{save_tbl}",
+                                              st.session_state["run_info"])
+                st.success(f"✅ Successfully added run {run_id} to {save_db}.{save_schema}.{save_tbl}!")
             st.session_state["saved"] = True